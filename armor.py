@@ -0,0 +1,95 @@
+"""
+This file contains time-to-breach calculations for layered armor.
+
+Armor layout is a list of materials from Materials, from the outer layer to the inner one:
+    ['metal', 'metal', 'HA_beam']
+Each shot deals its damage profile (see calcWeaponDPS) to the outermost intact layer.
+Damage of each component is scaled by armor modifier for its AP and layer AC.
+When a layer is destroyed, the rest of the shot goes to the next layer, so a layer takes
+h / d shots, where d is the modified damage of a shot for this layer. Shots are summed
+over layers, and a layout is breached after ceil(sum(h / d)) shots.
+
+All values are numpy arrays, so candidates from calcCannonDataBatch are evaluated against
+all armor layouts at once:
+    data = FTD.calcCannonDataBatch(config, velCharge=charges)
+    breach = calcBreach(data, ['metal', 'metal'], ['HA', 'alloy', 'alloy'])
+"""
+import numpy as np
+
+
+# AC and HP for armor materials, see ftd_calc docstring
+Materials = {
+    'metal': (15, 350),
+    'metal_beam': (15, 2100),
+    'wood': (3, 180),
+    'wood_beam': (3, 1080),
+    'alloy': (13, 260),
+    'alloy_beam': (13, 1560),
+    'HA': (40, 1000),
+    'HA_beam': (40, 6000),
+    'stone': (7, 300),
+    'stone_beam': (7, 1800),
+}
+
+
+def calcArmorModBatch(ap, armor):
+    """
+    Vectorized version of calcArmorMod. Modifier is limited by 1,
+    so shells with AP over armor class do not deal extra damage.
+    """
+    ap = np.asarray(ap, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mod = np.minimum(0.05 + 0.45 * ap / armor, 1.0)
+    return np.where(ap != 0, mod, 0.05)
+
+
+def makeArmorTable(*layouts):
+    """
+    Converts armor layouts to arrays
+    @param layouts: lists of material names, from outer layer to inner one
+    @returns (ac, hp) arrays with shape (layouts, depth). Missing layers have HP = 0
+    """
+    depth = max([len(layout) for layout in layouts], default=0)
+    ac = np.ones((len(layouts), depth))
+    hp = np.zeros((len(layouts), depth))
+    for i, layout in enumerate(layouts):
+        for j, material in enumerate(layout):
+            if material not in Materials:
+                raise ValueError("Unknown armor material: %s" % material)
+            ac[i, j], hp[i, j] = Materials[material]
+    return ac, hp
+
+
+def calcBreach(data, *layouts, hit=None):
+    """
+    Calculates shots and time to breach armor layouts
+    @param data: weapon data with damage and period, from calcCannonData or calcCannonDataBatch
+    @param layouts: lists of material names, from outer layer to inner one
+    @param hit: hit probability, like from calcEngagement. Every shot hits by default
+    @returns dict with arrays, which have shape of weapon data and one more axis for layouts:
+     - shots - number of shots to breach a layout
+     - time - time to breach a layout, using reload period for each shot
+    """
+    ac, hp = makeArmorTable(*layouts)
+    damage = list(data['damage'].values())
+    period = np.asarray(data['period'], dtype=float)[..., np.newaxis]
+    shape = np.broadcast_shapes(period.shape, *[np.shape(value) + (1,) for value, _ in damage])
+
+    shots = np.zeros(shape[:-1] + (len(layouts),))
+    for layer in range(ac.shape[1]):
+        per_shot = np.zeros(shots.shape)
+        for value, ap in damage:
+            value = np.asarray(value, dtype=float)[..., np.newaxis]
+            ap = np.asarray(ap, dtype=float)[..., np.newaxis]
+            per_shot = per_shot + value * calcArmorModBatch(ap, ac[:, layer])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shots = shots + np.where(hp[:, layer] > 0, hp[:, layer] / per_shot, 0)
+    # Avoid float noise like 2.0000000001 shots
+    shots = np.ceil(shots * (1 - 1e-12))
+    if hit is not None:
+        with np.errstate(divide='ignore'):
+            shots = shots / np.asarray(hit, dtype=float)[..., np.newaxis]
+    return {
+        "shots": shots,
+        "time": shots * period,
+    }
@@ -0,0 +1,195 @@
+"""
+This file contains blueprint atlas: a file with all shell blueprints for a module limit
+and their precalculated diameter-independent stats.
+
+Atlas is built once:
+    buildAtlas('atlas20.bin', 20)
+and then it is opened by any number of processes:
+    atlas = BlueprintAtlas('atlas20.bin')
+    optimizer = FTD.ShellOptimizer(max_modules=20, atlas=atlas)
+Columns are opened by numpy.memmap, so they are shared through OS page cache without copying.
+
+File layout:
+ - JSON header, padded to HeaderSize bytes
+ - 'shell' column with int8 part codes, max_modules codes per blueprint, padded by -1
+ - a column for each value from AtlasColumns
+Each column starts at an offset aligned to Alignment bytes.
+"""
+import json
+import numpy as np
+import ftd_calc as FTD
+from shell_gen import allBodyGen, countAllBodies
+from parts import Parts
+
+AtlasFormat = 'ftd-atlas'
+AtlasVersion = 3
+HeaderSize = 4096
+Alignment = 64
+
+# Diameter-independent columns and their types
+AtlasColumns = {
+    'speedC': 'f8',
+    'armorC': 'f8',
+    'kineticC': 'f8',
+    'expMod': 'f8',
+    'modules': 'i1',
+    'propellant': 'i1',
+    'rails': 'i1',
+    'bleeders': 'i1',
+    'numExplosive': 'i1',
+    'numFlak': 'i1',
+    'numFrag': 'i1',
+    'numSquash': 'i1',
+    'numShaped': 'i1',
+}
+
+
+def _layout(count, max_modules):
+    """
+    Calculates column offsets for the atlas file
+    @returns dict with (offset, dtype, shape) for each column
+    """
+    columns = {'shell': ('i1', (count, max_modules))}
+    columns.update({key: (dtype, (count,)) for key, dtype in AtlasColumns.items()})
+    layout = {}
+    offset = HeaderSize
+    for key, (dtype, shape) in columns.items():
+        layout[key] = (offset, dtype, shape)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        offset = (offset + Alignment - 1) // Alignment * Alignment
+    return layout, offset
+
+
+def buildAtlas(path, max_modules, chunk_size=65536):
+    """
+    Enumerates all blueprints with up to max_modules modules and writes them to atlas file.
+    Blueprints are processed in chunks, so memory usage does not depend on max_modules.
+    @param path: path to atlas file
+    @param max_modules: max number of modules in a blueprint
+    @param chunk_size: number of blueprints to be processed at once
+    @returns BlueprintAtlas
+    """
+    if max_modules > np.iinfo(np.int8).max:
+        raise ValueError("Too many modules for atlas: %d" % max_modules)
+    count = countAllBodies(max_modules)
+    layout, size = _layout(count, max_modules)
+    header = {
+        "format": AtlasFormat,
+        "version": AtlasVersion,
+        "max_modules": max_modules,
+        "count": count,
+        "parts": FTD.ShellParts,
+        "fingerprint": Parts.fingerprint,
+        "columns": {key: [offset, dtype, list(shape)] for key, (offset, dtype, shape) in layout.items()},
+    }
+    data = json.dumps(header).encode('utf-8')
+    if len(data) >= HeaderSize:
+        raise ValueError("Atlas header is too big")
+    with open(path, 'wb') as file:
+        file.write(data.ljust(HeaderSize, b' '))
+        file.truncate(size)
+
+    columns = {key: np.memmap(path, dtype=dtype, mode='r+', offset=offset, shape=shape)
+               for key, (offset, dtype, shape) in layout.items()}
+    start = 0
+    chunk = []
+    for blueprint in allBodyGen(max_modules):
+        chunk.append(blueprint)
+        if len(chunk) == chunk_size:
+            _writeChunk(columns, start, chunk, max_modules)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        _writeChunk(columns, start, chunk, max_modules)
+    for column in columns.values():
+        column.flush()
+    del columns
+    return BlueprintAtlas(path)
+
+
+def _writeChunk(columns, start, blueprints, max_modules):
+    codes, stats = FTD.calcBulletColumns(blueprints, max_modules)
+    stop = start + len(blueprints)
+    columns['shell'][start:stop] = codes
+    for key in AtlasColumns:
+        columns[key][start:stop] = stats[key]
+
+
+class BlueprintAtlas:
+    """
+    Read-only access to atlas file. All columns are memory mapped.
+    """
+    def __init__(self, path):
+        """
+        @param path: path to atlas file from buildAtlas
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            header = json.loads(file.read(HeaderSize).decode('utf-8'))
+        if header.get('format') != AtlasFormat or header.get('version') != AtlasVersion:
+            raise ValueError("%s is not a blueprint atlas of version %d" % (path, AtlasVersion))
+        if header.get('fingerprint') != Parts.fingerprint:
+            raise ValueError("%s is built for other part values, it should be rebuilt" % path)
+        self.header = header
+        self.max_modules = header['max_modules']
+        # Part names for codes in 'shell' column
+        self.parts = header['parts']
+        self._columns = {key: np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+                         for key, (offset, dtype, shape) in header['columns'].items()}
+        # Sorted index for find. It is built on the first lookup
+        self._keys = None
+        self._order = None
+
+    def __len__(self):
+        return self.header['count']
+
+    def codes(self, start=0, stop=None):
+        """Integer coded blueprints, one per row"""
+        return self._columns['shell'][start:stop]
+
+    def columns(self, start=0, stop=None):
+        """
+        Diameter-independent stats for blueprints in range [start, stop)
+        @returns dict with memory mapped arrays for AtlasColumns
+        """
+        return {key: self._columns[key][start:stop] for key in AtlasColumns}
+
+    def blueprint(self, index):
+        """Blueprint as a list of part names"""
+        return FTD.decodeBlueprint(self._columns['shell'][index], self.parts)
+
+    def _rowKeys(self, codes):
+        """Rows of integer codes as single byte strings, which can be sorted and compared"""
+        codes = np.ascontiguousarray(codes, dtype=np.int8)
+        return codes.view(np.dtype((np.void, codes.shape[1]))).ravel()
+
+    def find(self, blueprint):
+        """
+        Finds a blueprint in atlas by binary search over sorted rows.
+        The index is built on the first call, it takes 8 bytes per blueprint
+        @returns index of the blueprint or None
+        """
+        if len(blueprint) > self.max_modules or any(part not in self.parts for part in blueprint):
+            return None
+        if self._order is None:
+            self._keys = self._rowKeys(self._columns['shell'])
+            # Stable sort keeps the lowest index first for duplicate blueprints
+            self._order = np.argsort(self._keys, kind='stable')
+        target = self._rowKeys(FTD.encodeBlueprints([blueprint], self.max_modules, self.parts))[0]
+        position = np.searchsorted(self._keys, target, sorter=self._order)
+        if position < len(self._order) and self._keys[self._order[position]] == target:
+            return int(self._order[position])
+        return None
+
+    def stats(self, index, diameter=None):
+        """
+        Stats for a blueprint, the same as calcBulletStats, but without calculations
+        @param index: index of the blueprint
+        @param diameter: shell diameter. Geometry is calculated if it is set
+        @returns weapon config
+        """
+        config = FTD.configFromColumns(self._columns, index)
+        config["shell"] = self.blueprint(index)
+        if diameter is not None:
+            FTD.calcBulletGeometry(config, diameter)
+        return config
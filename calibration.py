@@ -0,0 +1,202 @@
+"""
+This file contains calibration of formula constants against reference game data.
+
+Reference readings are taken from the shell designer in game. Each reading has a blueprint,
+diameter, optional rail charge and loader layout, and some of measured values:
+ - velocity - shell velocity
+ - kinetic - kinetic damage
+ - ap - armor piercing
+ - explosive - HE damage
+ - T - load time
+These are the same values, which are checked by run_verification.
+
+Usage:
+    readings = loadReadings('readings.csv')
+    result = fitConstants(readings, ['propellantVelocity', 'kineticScale'])
+    printResiduals(result)
+    FTD.saveConstants('constants.json', result['constants'], residuals=result['residuals'])
+Then calculators can use them:
+    FTD.loadConstants('constants.json')
+
+All readings are evaluated by a single calcCannonDataBatch call, so fitting is fast even
+for thousands of readings.
+"""
+import csv
+import json
+import re
+import numpy as np
+import ftd_calc as FTD
+
+
+# Measured fields and functions to get them from calcCannonDataBatch results
+ReadingFields = {
+    'velocity': lambda data: data['velocity'],
+    'kinetic': lambda data: data['damage']['kinetic'][0],
+    'ap': lambda data: data['damage']['kinetic'][1],
+    'explosive': lambda data: data['damage']['HE'][0] if 'HE' in data['damage'] else 0,
+    'T': lambda data: data['period'],
+}
+
+# Weapon settings of a reading, and their config keys
+ReadingSettings = {
+    'diameter': 'diameter',
+    'charge': 'velCharge',
+    'loaders': 'loaders',
+    'clipsPerLoader': 'clipsPerLoader',
+    'belt': 'belt',
+}
+
+
+def loadReadings(path):
+    """
+    Loads reference readings from JSON or CSV file.
+    JSON file contains a list of dicts, like real_data in workbench.py.
+    CSV file has a header with field names. Shell parts are separated by spaces,
+    empty cells are treated as missing values.
+    @returns list of readings
+    """
+    if path.endswith('.json'):
+        with open(path) as file:
+            return json.load(file)
+    readings = []
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            reading = {}
+            for key, value in row.items():
+                if value is None or value.strip() == '':
+                    continue
+                if key == 'shell':
+                    reading[key] = re.split(r'[\s|;]+', value.strip())
+                else:
+                    reading[key] = float(value)
+            readings.append(reading)
+    return readings
+
+
+def stackReadings(readings):
+    """
+    Converts readings to arrays for calcCannonDataBatch
+    @returns (config, targets): stacked weapon configs and dict with (values, mask) for each field
+    """
+    codes, config = FTD.calcBulletColumns([reading['shell'] for reading in readings])
+    for key, setting in ReadingSettings.items():
+        default = FTD.BatchKeys[setting]
+        config[setting] = np.array([reading.get(key, default) for reading in readings], dtype=float)
+    config['belt'] = config['belt'].astype(bool)
+    targets = {}
+    for field in ReadingFields:
+        mask = np.array([field in reading for reading in readings])
+        if np.any(mask):
+            values = np.array([reading.get(field, 0) for reading in readings], dtype=float)
+            targets[field] = (values, mask)
+    return config, targets
+
+
+def calcResiduals(config, targets, constants):
+    """
+    Calculates relative residuals (model - reference) / reference
+    @param constants: dict with constants. Values can be arrays with shape (sets, 1)
+    @returns dict with residuals for each field, missing values are 0
+    """
+    data = FTD.calcCannonDataBatch(config, diameter=config['diameter'], constants=constants)
+    residuals = {}
+    for field, (values, mask) in targets.items():
+        model = np.asarray(ReadingFields[field](data), dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            residual = np.where(mask, (model - values) / np.where(values != 0, values, 1), 0)
+        residuals[field] = residual
+    return residuals
+
+
+def _summary(residuals, targets):
+    """RMS and max relative error for each field"""
+    summary = {}
+    for field, (values, mask) in targets.items():
+        residual = np.broadcast_to(residuals[field], mask.shape)[mask]
+        summary[field] = {
+            "count": int(len(residual)),
+            "rms": float(np.sqrt(np.mean(residual**2))),
+            "max": float(np.max(np.abs(residual))),
+        }
+    return summary
+
+
+def fitConstants(readings, names, fields=None, iterations=50, tolerance=1e-10):
+    """
+    Fits formula constants to reference readings by Levenberg-Marquardt least squares
+    over relative residuals. Jacobian is calculated by finite differences, and all
+    steps are evaluated together with the current point in a single batched call.
+    @param readings: list of readings, see loadReadings
+    @param names: names of constants from FTD.Constants to be fitted
+    @param fields: fields to be fitted. All available fields are used by default
+    @param iterations: max number of iterations
+    @param tolerance: stop when relative cost change is lower
+    @returns dict with:
+     - constants - dict with all constants, including fitted ones
+     - residuals - dict with count, rms and max relative error for each field after fitting
+     - initial - the same for initial constants
+     - readings - number of readings
+    """
+    for name in names:
+        if name not in FTD.Constants:
+            raise ValueError("Unknown constant: %s" % name)
+    config, targets = stackReadings(readings)
+    if fields is not None:
+        targets = {field: targets[field] for field in fields if field in targets}
+    if not targets:
+        raise ValueError("Readings have no fields to be fitted")
+
+    def evaluate(points):
+        # points: (sets, constants) -> residuals with shape (sets, readings * fields)
+        constants = {name: points[:, i, np.newaxis] for i, name in enumerate(names)}
+        residuals = calcResiduals(config, targets, constants)
+        return np.concatenate([np.broadcast_to(residuals[field], (len(points), len(readings)))
+                               for field in targets], axis=1)
+
+    x = np.array([FTD.Constants[name] for name in names], dtype=float)
+    initial = calcResiduals(config, targets, {})
+    damping = 1e-3
+    cost = None
+    for _ in range(iterations):
+        step = 1e-6 * np.maximum(np.abs(x), 1e-3)
+        points = np.vstack([x, x + np.diag(step)])
+        values = evaluate(points)
+        r = values[0]
+        cost = float(r @ r)
+        jacobian = ((values[1:] - r) / step[:, np.newaxis]).T
+        hessian = jacobian.T @ jacobian
+        gradient = jacobian.T @ r
+        improved = False
+        while damping < 1e10:
+            delta = np.linalg.solve(hessian + damping * np.diag(np.diag(hessian) + 1e-12), -gradient)
+            trial = evaluate((x + delta)[np.newaxis])[0]
+            trial_cost = float(trial @ trial)
+            if np.isfinite(trial_cost) and trial_cost < cost:
+                damping = max(damping / 3, 1e-9)
+                improved = True
+                break
+            damping *= 3
+        if not improved:
+            break
+        x = x + delta
+        if cost - trial_cost <= tolerance * cost:
+            break
+
+    constants = dict(FTD.Constants)
+    constants.update({name: float(x[i]) for i, name in enumerate(names)})
+    final = calcResiduals(config, targets, constants)
+    return {
+        "constants": constants,
+        "residuals": _summary(final, targets),
+        "initial": _summary(initial, targets),
+        "readings": len(readings),
+    }
+
+
+def printResiduals(result):
+    """Prints relative errors for each field before and after fitting"""
+    print("Readings: %d" % result['readings'])
+    for field, after in result['residuals'].items():
+        before = result['initial'][field]
+        print(" - %s (%d): rms %.2f%% -> %.2f%%, max %.2f%% -> %.2f%%" % (
+            field, after['count'], before['rms']*100, after['rms']*100, before['max']*100, after['max']*100))
@@ -0,0 +1,94 @@
+"""
+This file contains engagement model: expected hit probability and delivered DPS at given ranges.
+
+calcCannonData reports DPS as if every shell hits. Here each shot is a point, uniformly
+distributed over the spread disc with radius range*tan(accuracy). Target is a disc with
+diameter target_size. A manoeuvring target moves away from the aim point during flight time,
+so the spread disc is shifted by 0.5*target_accel*time^2. Hit probability is the part
+of the spread disc, which is covered by the target.
+
+Everything is calculated by numpy, so candidates from calcCannonDataBatch are evaluated
+against all ranges at once:
+    data = FTD.calcCannonDataBatch(config, velCharge=charges)
+    engagement = calcEngagement(data, ranges=[1000, 2000, 3000], target_size=10)
+"""
+import math
+import numpy as np
+
+Gravity = 9.81
+
+# Default target size, in meters
+DefaultTargetSize = 10.0
+
+
+def calcCircleOverlap(r1, r2, distance):
+    """
+    Calculates overlap area of two circles
+    @param r1, r2: radii of circles
+    @param distance: distance between centers
+    @returns array with areas
+    """
+    r1, r2, distance = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value in (r1, r2, distance)])
+    small = np.minimum(r1, r2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a1 = np.arccos(np.clip((distance**2 + r1**2 - r2**2) / (2*distance*r1), -1, 1))
+        a2 = np.arccos(np.clip((distance**2 + r2**2 - r1**2) / (2*distance*r2), -1, 1))
+        kite = (-distance + r1 + r2) * (distance + r1 - r2) * (distance - r1 + r2) * (distance + r1 + r2)
+        lens = r1**2 * a1 + r2**2 * a2 - 0.5 * np.sqrt(np.maximum(kite, 0))
+    area = np.where(distance >= r1 + r2, 0.0, lens)
+    return np.where(distance <= np.abs(r1 - r2), math.pi * small**2, area)
+
+
+def calcHitProbability(accuracy, velocity, ranges, target_size=DefaultTargetSize, target_accel=0):
+    """
+    Calculates hit probability for each candidate and each range
+    @param accuracy: inaccuracy in degrees, as from calcAccuracy. Can be an array
+    @param velocity: shell velocity, m/s. Can be an array
+    @param ranges: list of ranges, m
+    @param target_size: target diameter, m
+    @param target_accel: target acceleration, m/s^2. It makes a lead error during flight time
+    @returns (hit, time) arrays with shape of accuracy and velocity, and one more axis for ranges
+    """
+    accuracy = np.asarray(accuracy, dtype=float)[..., np.newaxis]
+    velocity = np.asarray(velocity, dtype=float)[..., np.newaxis]
+    ranges = np.asarray(ranges, dtype=float)
+    target = 0.5 * target_size
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        time = np.where(velocity > 0, ranges / velocity, np.inf)
+    spread = ranges * np.tan(np.radians(accuracy))
+    miss = 0.5 * target_accel * time**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hit = calcCircleOverlap(spread, target, miss) / (math.pi * spread**2)
+    # Precise gun: all shells go to the same point
+    hit = np.where(spread > 0, hit, miss < target)
+    # Shell can not reach the target
+    hit = np.where(ranges <= velocity**2 / Gravity, np.minimum(hit, 1.0), 0.0)
+    return hit, time
+
+
+def calcEngagement(data, ranges, target_size=DefaultTargetSize, target_accel=0, weights=None):
+    """
+    Calculates expected hit probability and delivered DPS over a set of ranges
+    @param data: weapon data with accuracy, velocity and dps, from calcCannonData or calcCannonDataBatch
+    @param ranges: list of ranges, m
+    @param target_size: target diameter, m
+    @param target_accel: target acceleration, m/s^2
+    @param weights: weights for ranges. All ranges are equal by default
+    @returns dict with:
+     - hit - mean hit probability over ranges
+     - delivered_dps - mean expected DPS over ranges
+     - hitByRange - hit probability for each range, in the last axis
+     - flightTime - flight time for each range, in the last axis
+    """
+    hit, time = calcHitProbability(data['accuracy'], data['velocity'], ranges, target_size, target_accel)
+    if weights is None:
+        weights = np.ones(len(ranges))
+    weights = np.asarray(weights, dtype=float) / np.sum(weights)
+    mean_hit = np.sum(hit * weights, axis=-1)
+    return {
+        "hit": mean_hit,
+        "delivered_dps": mean_hit * np.asarray(data['dps'], dtype=float),
+        "hitByRange": hit,
+        "flightTime": time,
+    }
@@ -1,6 +1,13 @@
 import math
+import json
 from copy import copy
+import heapq
+import numpy as np
 from shell_gen import *
+from score import ScoreExpression, makeScoreFn, scoreFields, EngagementFields, BreachFields
+from engagement import calcEngagement, DefaultTargetSize
+from armor import calcBreach
+from parts import Parts
 
 """
 This module contains formulas for advanced cannons in From The Depths game
@@ -30,85 +37,79 @@ Thump damage is dealt by:
     Rams (AP 15)
 """
 
-            
-# Speed modifier for the shell's part
-ShellSpeedMod = {
-    "rail": 1.0,
-    "gunpowder": 1.0,
-    "bleeder": 1.1,
-    "bsabot": 1.75,
-    "HE": 1.0,
-    "solid": 1.3,
-    "flak": 1.0,
-    "stab": 0.95,
-    "frag": 1.0, 
-    "squash": 1.0,
-    "sabot": 2.05,
-    "scharge": 1.4,
-    "hollow": 1.4,
-    "apcap": 1.5,
-    "composite": 1.6,
-    "flakhead": 1.4,
-    "fraghead": 1.4,
-    "HEhead": 1.4,
-    "skimmer": 1.75,
+
+# Formula constants. Most of them are taken from the wiki, and they can be calibrated
+# against game data, see calibration.py. Calibrated constants are loaded by loadConstants
+Constants = {
+    # Propellant velocity: propellantVelocity * volume**propellantVolumeExp * ...
+    "propellantVelocity": 700.0,
+    "propellantVolumeExp": 0.03,
+    # Kinetic damage: kineticScale * kineticC * velocity * (125 * D**2 * length)**kineticExp
+    "kineticScale": 1.25,
+    "kineticExp": 0.65,
+    # Armor piercing: apScale * armorC * velocity
+    "apScale": 0.01,
+    # Explosive damage: explosiveDamage * (125 * D**3 * modules)**explosiveExp
+    "explosiveDamage": 500.0,
+    "explosiveExp": 0.65,
+    # Load time for clips and belt loaders: loadTime * loaders**0.25 * volume**0.5
+    "clipLoadTime": 50.0,
+    "beltLoadTime": 10.0,
 }
 
+ConstantsFormat = 'ftd-constants'
+ConstantsVersion = 1
+
+
+def loadConstants(path):
+    """
+    Loads formula constants from a file, written by saveConstants.
+    Loaded values replace values in Constants, so all calculators use them
+    @returns dict with file contents
+    """
+    with open(path) as file:
+        data = json.load(file)
+    if data.get('format') != ConstantsFormat or data.get('version') != ConstantsVersion:
+        raise ValueError("%s is not a constants file of version %d" % (path, ConstantsVersion))
+    unknown = [key for key in data['constants'] if key not in Constants]
+    if unknown:
+        raise ValueError("Unknown constants in %s: %s" % (path, ", ".join(unknown)))
+    Constants.update(data['constants'])
+    return data
+
+
+def saveConstants(path, constants=None, **info):
+    """
+    Writes formula constants to a file
+    @param constants: dict with constants. Current Constants are written by default
+    @param info: additional values to be stored, like calibration residuals
+    """
+    data = {
+        "format": ConstantsFormat,
+        "version": ConstantsVersion,
+        "parts": Parts.fingerprint,
+        "constants": {key: float(value) for key, value in dict(Constants, **(constants or {})).items()},
+    }
+    data.update(info)
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+
+
+# Part tables by name. Values are loaded to the part registry from parts.json,
+# these dicts are kept for reading single values
+# Speed modifier for the shell's part
+ShellSpeedMod = Parts.table(Parts.speed)
+
 # Armor piercing modifier for the shell's part
-ShellApMod = {
-    "rail": 1,
-    "gunpowder": 1,
-    "bleeder": 1,
-    "bsabot": 3.6,
-    "HE": 1.5,
-    "solid": 2,
-    "flak": 0.4,
-    "stab": 0.5,
-    "frag": 1.5,
-    "squash": 0.3,
-    "sabot": 6.75,
-    "scharge": 0.1,
-    "hollow": 0.25,
-    "apcap": 3.5,
-    "composite": 4.5,
-    "flakhead": 0.1,
-    "fraghead": 0.1,
-    "skimmer": 3.0,
-    "HEhead": 0.1,
-}
+ShellApMod = Parts.table(Parts.ap)
 
 # Kinetic modifier for the shell's part
-ShellKineticMod = {
-    "rail": 1.0,
-    "gunpowder": 1.0,
-    "bleeder": 1.0,
-    "bsabot": 2.7,
-    "HE": 2.5,
-    "solid": 5,
-    "flak": 0.4,
-    "stab": 0.7,
-    "frag": 0.8, 
-    "squash": 0.4,
-    "sabot": 1.8,
-    "scharge": 0.5,
-    "hollow": 1.2,
-    "apcap": 10.0,
-    "composite": 5.0,
-
-    "flakhead": 2.5,
-    "fraghead": 2.5,
-    "skimmer": 3.0,
-    "HEhead": 2.5
-}
+ShellKineticMod = Parts.table(Parts.kinetic)
 
-## "fraghead", "skimmer", "hollow", "HEhead"
-
-TailParts = ['rail', 'gunpowder']
+TailParts = [name for name in Parts.names if Parts.tail[Parts.id(name)]]
 
 # Limits to shell module length
-ShellModuleLength = {
-    "bleeder": 0.1,
-}
+ShellModuleLength = {name: length for name, length in Parts.table(Parts.length).items() if length != 1.0}
 
 
 def calcShellVolume(diameter, length):
@@ -146,8 +147,8 @@ def calcVelocityFromPropellant(context):
     shell_length = context["shellLength"]
     speed_mod = context.get("speedC", 1.0)
     
-    volume = calcShellVolume(diameter, shell_length)**0.03
-    return 700.0 * propellant * speed_mod * volume * diameter / length
+    volume = calcShellVolume(diameter, shell_length)**Constants["propellantVolumeExp"]
+    return Constants["propellantVelocity"] * propellant * speed_mod * volume * diameter / length
 
 
 def calcVelocityFromRails(context):
@@ -197,9 +198,9 @@ def calcClipToAutoloader(context):
     total_loaders = context.get("loaders", 1)
     volume = calcShellVolume(diameter, length)
     if context.get("belt", False):
-        return 10 * total_loaders**0.25 * volume**0.5
+        return Constants["beltLoadTime"] * total_loaders**0.25 * volume**0.5
     clips_attached = context.get("clipsPerLoader", 1)
-    return 50 * total_loaders**0.25 * (volume / clips_attached)**0.5
+    return Constants["clipLoadTime"] * total_loaders**0.25 * (volume / clips_attached)**0.5
 
 
 def calcBarrelCooldown(diameter, propellant, num_cooling):
@@ -235,7 +236,7 @@ def calcAccuracy(context):
 
 def calcBaseAp(context):
     vel = calcTotalVelocity(context)
-    ap = 0.01 * context["armorC"] * vel
+    ap = Constants["apScale"] * context["armorC"] * vel
     return ap
 
 
@@ -245,13 +246,13 @@ def calcKineticDamage(context):
     module_length = calcShellModuleLength(context)
     kineticC = context["kineticC"]
     vel = calcTotalVelocity(context)
-    ap = 0.01 * context["armorC"] * vel
-    return 1.25 * kineticC * vel * (125 * diameter**2 * length) ** 0.65, ap
+    ap = Constants["apScale"] * context["armorC"] * vel
+    return Constants["kineticScale"] * kineticC * vel * (125 * diameter**2 * length) ** Constants["kineticExp"], ap
     #return 1.25 * kineticC * vel * (125 * diameter**3 * module_length) ** 0.65, ap
 
 
-def calcExplosiveDamage(diameter, num_explosive):
-    return 500 * (125*diameter**3 * num_explosive)**0.65
+def calcExplosiveDamage(diameter, num_explosive, constants=Constants):
+    return constants["explosiveDamage"] * (125*diameter**3 * num_explosive)**constants["explosiveExp"]
 
 
 def calcFlakDamage(diameter, num_flak):
@@ -291,6 +292,18 @@ def calcShapeChargeDamage(diameter, num_explosive, factor):
     return 200 * particle_count, 10
     
 
+# Armor piercing for fragments
+FragAp = 6
+
+# Expected part of fragments, which hit the target. Fragments fly out in a cone from the impact point,
+# so most of them miss a target of a typical size. It is an estimate, not a game value.
+# It can be set for a weapon config as 'fragHit', and 1 counts every fragment
+FragHitFraction = 0.25
+
+# Part of shaped charge payload, which is used for penetration metric. The rest makes particles
+ShapedChargeFactor = 0.5
+
+
 # Total damage from fragmentation parts
 # Note: all frags have AP=6
 def calcTotalFragDamage(diameter, frags):
@@ -305,7 +318,8 @@ def calcArmorMod(ap, armor):
 
 def calcWeaponDPS(context):
     """
-    Calculates the best DPS for a weapon, considering there are enough reloaders and coolers
+    Calculates the best DPS for a weapon, considering there are enough reloaders and coolers.
+    Frag damage counts only the expected part of fragments, which hit the target, see FragHitFraction
     """
     diameter = context.get("diameter")
     
@@ -336,6 +350,18 @@ def calcWeaponDPS(context):
         damage["flak"] = (damage_flak, base_ap)
     
     armor = context.get("armor", 8)
+
+    num_frag = context.get("numFrag", 0)
+    if num_frag != 0:
+        damage["frag"] = (calcTotalFragDamage(diameter, num_frag) * context.get("fragHit", FragHitFraction), FragAp)
+
+    num_squash = context.get("numSquash", 0)
+    if num_squash != 0:
+        damage["squash"], damage["spall"] = calcSquashDamage(diameter, num_squash, armor)
+
+    num_shaped = context.get("numShaped", 0)
+    if num_shaped != 0:
+        damage["shaped"] = calcShapeChargeDamage(diameter, num_shaped, ShapedChargeFactor)
     
     damage_total = 0
     # Calculates DPS using damage profile
@@ -357,81 +383,27 @@ def calcWeaponDPS(context):
     return result
 
 
-def shell_module_size(shell_blueprint):
-    """
-    Calculate shell module size for a blueprint
-    @param shell_blueprint:
-    @return:int number of modules in the shell, ignorign casing modumes
-    """
-    size = 0
-    for i in range(0, len(shell_blueprint)):
-        if shell_blueprint[i] in TailParts:
-            break
-        size += 1
-    return size
+def _blueprintColumns(shell):
+    """Stats for a single blueprint from the part registry, see PartRegistry.calcColumns"""
+    codes = encodeBlueprints([shell], len(shell))
+    return codes[0], Parts.calcColumns(codes)
 
 
-# Calculates speed modifier for a shell
+# Calculates speed modifier for a shell, without speed bonus
 def calcSpeedMod(shell):
-    up = 0
-    down = 0
-    for i in range(0, len(shell)):
-        module = shell[i]
-        if module in TailParts:
-            break
-        weight = 0.75**i
-        mod = ShellSpeedMod.get(module, 1.0)
-        up += mod * weight
-        down += weight
-    
-    return up / down if down > 0 else 1.0
+    codes, columns = _blueprintColumns(shell)
+    bonus = np.max(Parts.speedBonus[codes[codes >= 0]], initial=0.0)
+    return float(columns['speedC'][0] / (1 + bonus))
 
 
 # Calculates armor piercing modifier
 def calcApMod(shell):
-    up = 0
-    down = 0
-    size = shell_module_size(shell)
-    for i in range(0, max(size, 3)):
-        weight = 0.75**i
-        mod = ShellApMod.get(shell[i], 1.0) if i < size else 0.5
-        up += mod * weight
-        down += weight
-    return up / down if down > 0 else 1.0
-
-
-def calcApModTest(shell):
-    up = []
-    down = []
-    size = shell_module_size(shell)
-    for i in range(0, max(size, 3)):
-        weight = 0.75**i
-        mod = ShellApMod.get(shell[i], 1.0) if i < size else 0.5
-        up.append(mod * weight)
-        down.append(weight)
-    return up, down
+    return float(_blueprintColumns(shell)[1]['armorC'][0])
 
 
 # Calculates kinetic modifier for the shell
 def calcKineticMod(shell):
-    up = 0
-    down = 0
-    size = shell_module_size(shell)
-    for i in range(0, max(size, 3)):
-        mod = ShellKineticMod.get(shell[i], 1.0) if i < size else 0.5
-        up += mod
-        down += 1
-    
-    return up / down if down > 0 else -1.0
-
-
-def calcKineticModTest(shell):
-    up = []
-    size = shell_module_size(shell)
-    for i in range(0, max(size, 3)):
-        mod = ShellKineticMod.get(shell[i], 1.0) if i < size else 0.5
-        up.append(mod)
-    return up
+    return float(_blueprintColumns(shell)[1]['kineticC'][0])
 
 
 def calcBulletStats(blueprint, diameter=None):
@@ -441,17 +413,21 @@ def calcBulletStats(blueprint, diameter=None):
     @param diameter - shell diameter
     @return:dict weapon config, used for further calculations
 
-    It will contain:
-     - kineticC": calcKineticMod(blueprint),
-     - speedC": calcSpeedMod(blueprint) * (1+bleeder),
-     - armorC": calcApMod(blueprint),
-     - modules": len(blueprint),
-     - expMod": explosive_mod,  # Applies for explosive, flak, EMP
-     - shell: shell blueprint: copy(blueprint),
+    Part values are taken from the part registry, see Parts.calcColumns. It will contain:
+     - kineticC - kinetic modifier, mean of part modifiers over at least 3 slots
+     - speedC - speed modifier, weighted mean of part modifiers with speed bonus of tail parts
+     - armorC - armor piercing modifier, weighted mean of part modifiers over at least 3 slots
+     - modules - number of modules
+     - expMod - explosive modifier. Applies for explosive, flak, EMP
+     - shell - copy of the blueprint
      - propellant - number of propellant modules
      - rails - number of railgun casings
-     - numExplosive - number of explosive modules
-     - numFlak - number of flak modules
+     - numExplosive - number of explosive modules, including HE head
+     - numFlak - number of flak modules, including flak head
+     - numFrag - number of frag modules, including frag head
+     - numSquash - number of squash heads
+     - numShaped - number of shaped charge heads
+     - bleeders - number of base bleeder modules
 
     It will calculate geometry if diameter is not None:
      - shellLength - length of the shell, in meters
@@ -459,46 +435,10 @@ def calcBulletStats(blueprint, diameter=None):
      - diameter - assigned diameter
     """
 
-    bleeder = 0.0
-    explosive = 0
-    flak = 0
-    rails = 0
-    propellant = 0
-    explosive_mod = 1.0
-    flak_mod = 1.0
-    
-    for part in blueprint:
-        if part == "bleeder":
-            # Only one bleeder is allowed
-            bleeder = 0.2
-        elif part == "HE":
-            explosive += 1
-        elif part == "flak":
-            flak += 1
-        elif part == "gunpowder":
-            propellant += 1
-        elif part == "rail":
-            rails += 1
-        elif part == 'sabot' or part == 'bsabot':
-            explosive_mod = 0.25
-            
-    result = {
-        "kineticC": calcKineticMod(blueprint),
-        "speedC": calcSpeedMod(blueprint) * (1+bleeder),
-        "armorC": calcApMod(blueprint),
-        "modules": len(blueprint),
-        "expMod": explosive_mod,  # Applies for explosive, flak, EMP
-        "shell": copy(blueprint),
-    }
-    if propellant > 0:
-        result["propellant"] = propellant
-    if explosive > 0:
-        result["numExplosive"] = explosive
-    if flak > 0:
-        result["numFlak"] = flak
-    if rails > 0:
-        result["rails"] = rails
-        
+    codes = encodeBlueprints([blueprint], len(blueprint))
+    result = configFromColumns(Parts.calcColumns(codes), 0)
+    result["shell"] = copy(blueprint)
+
     if diameter is not None:
         calcBulletGeometry(result, diameter)
         
@@ -515,8 +455,9 @@ def calcBulletGeometry(config, diameter):
     length = 0
     
     for part in config.get('shell', []):
-        partLength = min(ShellModuleLength.get(part, 1.0), diameter)
-        if part not in TailParts and part != 'bleeder':
+        part = Parts.id(part)
+        partLength = min(Parts.length[part].item(), diameter)
+        if not Parts.casing[part]:
             shellLength += partLength
         length += partLength
         
@@ -526,6 +467,20 @@ def calcBulletGeometry(config, diameter):
     return config
 
 
+def calcLoaderBlocks(loaders, clipsPerLoader, loader_length):
+    """
+    Number of blocks in autoloader complex
+    @param loaders: number of autoloaders
+    @param clipsPerLoader: number of clips attached to each autoloader
+    @param loader_length: length of autoloader
+    """
+    # Autoloaders and clips
+    blocks = (loaders + clipsPerLoader) * loader_length
+    # Inserters
+    blocks += loaders * clipsPerLoader * 2
+    return blocks
+
+
 def calcCannonData(config):
     """
     Calculates weapon data that could be derived from shell data and diameter
@@ -557,13 +512,10 @@ def calcCannonData(config):
     loaders = config.get('loaders', 1)
     # Gauge complex
     blocks += coolers
-    # Autoloader complex
-    blocks += (loaders + config.get("clipsPerLoader", 1)) * autoloaderSize
-    # Inserters
-    blocks += loaders * config.get("clipsPerLoader", 1) * 2
+    blocks += calcLoaderBlocks(loaders, config.get("clipsPerLoader", 1), autoloaderSize)
 
     # Rail block
-    vel_charge = config.get('vel_charge', 0)
+    vel_charge = config.get('velCharge', 0)
     if vel_charge > 0:
         charge_per_second = vel_charge / config['period']
         # 100 charge per second
@@ -572,51 +524,966 @@ def calcCannonData(config):
 
     config['blocks'] = blocks
 
+    if config.get('ranges') is not None:
+        engagement = calcEngagementFor(config, config)
+        config["hit"] = float(engagement["hit"])
+        config["delivered_dps"] = float(engagement["delivered_dps"])
+    if config.get('armor_layouts') is not None:
+        config.update({key: float(value) for key, value in calcBreachFor(config, config).items()})
+
+    return config
+
+
+def calcEngagementFor(config, data):
+    """
+    Calculates engagement stats, using target settings from weapon config:
+     - ranges - list of ranges to the target, m
+     - target_size - target diameter, m
+     - target_accel - target acceleration, m/s^2
+     - range_weights - weights for ranges
+    @param data: weapon data with accuracy, velocity and dps
+    @returns dict from calcEngagement
+    """
+    return calcEngagement(data, config['ranges'],
+                          target_size=config.get('target_size', DefaultTargetSize),
+                          target_accel=config.get('target_accel', 0),
+                          weights=config.get('range_weights'))
+
+
+def calcBreachFor(config, data):
+    """
+    Calculates time to breach armor layouts from weapon config:
+     - armor_layouts - list of armor layouts, each of them is a list of materials from armor.Materials
+    Hit probability is used when engagement is calculated as well.
+    @param data: weapon data with damage, period and optional hit
+    @returns dict with breach_shots and breach_time, averaged over armor layouts
+    """
+    breach = calcBreach(data, *config['armor_layouts'], hit=data.get('hit'))
+    return {
+        "breach_shots": np.mean(breach['shots'], axis=-1),
+        "breach_time": np.mean(breach['time'], axis=-1),
+    }
+
+
+def calcBulletGeometryBatch(config, diameter):
+    """
+    Vectorized version of calcBulletGeometry
+    @param config: weapon config, containing 'shell' blueprint. Configs without blueprint,
+                   like ones from stackConfigs, use module counts instead
+    @param diameter: shell diameter, a number or an array
+    @returns (shellLength, length) arrays
+    """
+    diameter = np.asarray(diameter, dtype=float)
+    if 'shell' not in config:
+        # Only bleeder has limited length, all other modules are as long as diameter
+        casing = np.asarray(config.get('propellant', 0)) + np.asarray(config.get('rails', 0))
+        bleeders = np.asarray(config.get('bleeders', 0))
+        shellLength = diameter * (np.asarray(config['modules']) - casing - bleeders)
+        length = shellLength + diameter * casing + bleeders * np.minimum(Parts.length[Parts.id('bleeder')], diameter)
+        return shellLength, length
+    shellLength = np.zeros_like(diameter)
+    length = np.zeros_like(diameter)
+    for part in config.get('shell', []):
+        part = Parts.id(part)
+        partLength = np.minimum(Parts.length[part], diameter)
+        if not Parts.casing[part]:
+            shellLength = shellLength + partLength
+        length = length + partLength
+    return shellLength, length
+
+
+def calcLoaderPeriodFactor(loaders, clipsPerLoader, belt=False, constants=Constants):
+    """
+    Part of calcClipToAutoloader, which does not depend on a shell:
+        period = factor * volume**0.5
+    @returns array with factors
+    """
+    loaders = np.asarray(loaders, dtype=float)
+    clipsPerLoader = np.asarray(clipsPerLoader, dtype=float)
+    return np.where(belt, constants["beltLoadTime"] * loaders**0.25,
+                    constants["clipLoadTime"] * loaders**0.25 / clipsPerLoader**0.5)
+
+
+# Weapon settings, which describe loader layout
+LoaderSearchKeys = ['loaders', 'clipsPerLoader', 'belt', 'loader_length']
+
+
+def makeLoaderTable(loaders=1, clipsPerLoader=1, belt=False, loader_length=1):
+    """
+    Precalculates all combinations of loader layouts for a search.
+    Every argument can be a number or a list of values to be checked.
+    Loading time and block count for each layout do not depend on a shell, so they are
+    calculated here only once and are reused for every blueprint.
+    @returns dict with flat arrays: loaders, clipsPerLoader, belt, loader_length, periodFactor, loaderBlocks
+    """
+    values = [loaders, clipsPerLoader, belt, loader_length]
+    grids = np.meshgrid(*[np.atleast_1d(value) for value in values], indexing='ij')
+    table = {key: grid.ravel() for key, grid in zip(LoaderSearchKeys, grids)}
+    table['periodFactor'] = calcLoaderPeriodFactor(table['loaders'], table['clipsPerLoader'], table['belt'])
+    table['loaderBlocks'] = calcLoaderBlocks(table['loaders'], table['clipsPerLoader'], table['loader_length'])
+    return table
+
+
+# Config values, used by calcCannonDataBatch, with their default values
+BatchKeys = {
+    'diameter': 0, 'speedC': 1.0, 'armorC': 0, 'kineticC': 0, 'expMod': 1.0,
+    'modules': 0, 'propellant': 0, 'rails': 0, 'bleeders': 0, 'numExplosive': 0, 'numFlak': 0,
+    'numFrag': 0, 'numSquash': 0, 'numShaped': 0, 'armor': 8, 'fragHit': FragHitFraction,
+    'velCharge': 0, 'accCharge': 0, 'barrel': 10,
+    'loaders': 1, 'clipsPerLoader': 1, 'belt': False, 'loader_length': 1,
+}
+
+
+def stackConfigs(configs):
+    """
+    Stacks numeric values from several weapon configs to arrays, so they can be
+    evaluated by calcCannonDataBatch in a single call. Geometry is calculated
+    from module counts, when diameter is passed to calcCannonDataBatch.
+    @param configs: list of weapon configs, like results from ShellOptimizer
+    @returns dict with arrays
+    """
+    columns = {key: np.array([config.get(key, default) for config in configs], dtype=float)
+               for key, default in BatchKeys.items()}
+    columns['belt'] = columns['belt'].astype(bool)
+    return columns
+
+
+# All known shell parts. Integer coded blueprints use part ids from the registry, -1 is for empty slot
+ShellParts = Parts.names
+
+# Diameter-independent columns for blueprints, calculated by Parts.calcColumns
+BulletColumns = ['speedC', 'armorC', 'kineticC', 'expMod', 'modules',
+                 'propellant', 'rails', 'bleeders', 'numExplosive', 'numFlak',
+                 'numFrag', 'numSquash', 'numShaped']
+
+
+def encodeBlueprints(blueprints, width, parts=ShellParts):
+    """
+    Converts blueprints to integer codes
+    @param blueprints: list of blueprints
+    @param width: max number of modules in a blueprint
+    @param parts: list of part names
+    @returns int8 array with one blueprint per row, padded by -1
+    """
+    codes = np.full((len(blueprints), width), -1, dtype=np.int8)
+    index = Parts.ids if parts is ShellParts else {part: i for i, part in enumerate(parts)}
+    for row, blueprint in enumerate(blueprints):
+        try:
+            codes[row, :len(blueprint)] = [index[part] for part in blueprint]
+        except KeyError as e:
+            raise ValueError("Unknown shell part: %s" % e.args[0])
+    return codes
+
+
+def decodeBlueprint(codes, parts=ShellParts):
+    """
+    Converts integer codes back to a blueprint
+    @returns list with part names
+    """
+    return [parts[code] for code in codes if code >= 0]
+
+
+def calcBulletColumns(blueprints, width=None):
+    """
+    Calculates diameter-independent stats for several blueprints
+    @param blueprints: list of blueprints
+    @param width: max number of modules in a blueprint
+    @returns (codes, columns): integer coded blueprints and dict with arrays for BulletColumns
+    """
+    if width is None:
+        width = max([len(blueprint) for blueprint in blueprints], default=0)
+    codes = encodeBlueprints(blueprints, width)
+    stats = Parts.calcColumns(codes)
+    columns = {key: np.asarray(stats.get(key, np.zeros(len(codes))), dtype=float) for key in BulletColumns}
+    return codes, columns
+
+
+def configFromColumns(columns, row):
+    """
+    Makes a weapon config from a row of blueprint columns, like calcBulletStats does.
+    Modifiers are always set, counts are set only when they are not zero
+    @param columns: dict with arrays, like from calcBulletColumns
+    @param row: index of the blueprint
+    @returns weapon config without 'shell'
+    """
+    config = {}
+    for key in ['kineticC', 'speedC', 'armorC', 'expMod']:
+        config[key] = float(columns[key][row])
+    config['modules'] = int(columns['modules'][row])
+    for key in BulletColumns:
+        if key not in config and key in columns and columns[key][row] > 0:
+            config[key] = int(columns[key][row])
     return config
 
 
+def calcCannonDataBatch(config, **kwargs):
+    """
+    Vectorized version of calcCannonData.
+    Any numeric value from config or kwargs can be a numpy array. Values from kwargs
+    override values from config and all of them are broadcast together, so a whole grid
+    of rail charges can be evaluated in a single call:
+        calcCannonDataBatch(config, velCharge=np.linspace(0, 5000, 51))
+
+    Geometry is recalculated from the blueprint when diameter is overridden.
+    Precalculated 'periodFactor' and 'loaderBlocks' from makeLoaderTable are used when present.
+    Formula constants can be overridden by 'constants' dict. Its values can be arrays as well,
+    so several constant sets are evaluated at once, like in calibration.
+    @param config: weapon config, as produced by calcBulletStats
+    @returns dict with arrays: shellLength, length, vp, vr, velocity, period, damage, dps, coolers, accuracy, blocks
+    """
+    context = dict(config, **kwargs)
+
+    def value(key, default=0):
+        return np.asarray(context.get(key, default), dtype=float)
+
+    diameter = value('diameter')
+    if 'diameter' in kwargs or 'length' not in context:
+        shellLength, length = calcBulletGeometryBatch(context, diameter)
+    else:
+        shellLength, length = value('shellLength'), value('length')
+
+    propellant = value('propellant')
+    rails = value('rails')
+    speedC = value('speedC', 1.0)
+    charge = value('velCharge')
+    loaders = value('loaders', 1)
+    clips = value('clipsPerLoader', 1)
+    belt = np.asarray(context.get('belt', False), dtype=bool)
+    const = dict(Constants, **context.get('constants', {}))
+
+    # Velocity, the same as calcVelocityFromPropellant and calcVelocityFromRails
+    volume_mod = calcShellVolume(diameter, shellLength)**const['propellantVolumeExp']
+    vp = const['propellantVelocity'] * propellant * speedC * volume_mod * diameter / length
+    rail_mod = 6.0 - 5.0 * (0.9**rails)
+    vr = rail_mod * speedC * (8.0*charge)**0.5 / (125 * length * diameter**3)**0.25
+    velocity = vp + vr
+
+    # Loading time, the same as calcClipToAutoloader
+    if 'periodFactor' in context:
+        period_factor = value('periodFactor')
+    else:
+        period_factor = calcLoaderPeriodFactor(loaders, clips, belt, const)
+    period = period_factor * calcShellVolume(diameter, length)**0.5
+
+    damage = {}
+    kinetic_mod = (125 * diameter**2 * shellLength)**const['kineticExp']
+    kinetic = const['kineticScale'] * value('kineticC') * velocity * kinetic_mod
+    damage['kinetic'] = (kinetic, const['apScale'] * value('armorC') * velocity)
+    total = kinetic
+    num_explosive = value('numExplosive')
+    if np.any(num_explosive != 0):
+        damage['HE'] = (calcExplosiveDamage(diameter, num_explosive, const), damage['kinetic'][1])
+        total = total + damage['HE'][0]
+    num_flak = value('numFlak')
+    if np.any(num_flak != 0):
+        damage['flak'] = (calcFlakDamage(diameter, num_flak), damage['kinetic'][1])
+        total = total + damage['flak'][0]
+    num_frag = value('numFrag')
+    if np.any(num_frag != 0):
+        damage['frag'] = (calcTotalFragDamage(diameter, num_frag) * value('fragHit', FragHitFraction), FragAp)
+        total = total + damage['frag'][0]
+    num_squash = value('numSquash')
+    if np.any(num_squash != 0):
+        damage['squash'], damage['spall'] = calcSquashDamage(diameter, num_squash, value('armor', 8))
+        total = total + damage['squash'][0] + damage['spall'][0]
+    num_shaped = value('numShaped')
+    if np.any(num_shaped != 0):
+        damage['shaped'] = calcShapeChargeDamage(diameter, num_shaped, ShapedChargeFactor)
+        total = total + damage['shaped'][0]
+
+    # Coolers, the same as calcNumberOfCoolers
+    cooldown = 6 * (5*diameter)**1.5 * propellant**0.5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coolers = np.ceil(np.maximum(np.log(period / cooldown) / math.log(0.92), 0))
+    coolers = np.where(propellant > 0, coolers, 0)
+
+    # Accuracy, the same as calcAccuracy
+    barrel = value('barrel', 10)
+    free_barrel = barrel - propellant*diameter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base = np.where(free_barrel > 0, 4*length*diameter**0.5 / free_barrel, 0)
+    accuracy = base / (1 + 0.001 * value('accCharge') / (length*diameter))
+
+    # Blocks, the same as calcCannonData
+    blocks = 1 + np.where(propellant > 0, np.ceil(lengthForPropellant(propellant, diameter)), 0)
+    blocks = blocks + coolers
+    if 'loaderBlocks' in context:
+        blocks = blocks + value('loaderBlocks')
+    else:
+        blocks = blocks + calcLoaderBlocks(loaders, clips, value('loader_length', 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chargers = np.where(charge > 0, np.ceil(charge / period / 100) + 4, 0)
+    blocks = blocks + chargers
+
+    result = {
+        "shellLength": shellLength,
+        "length": length,
+        "vp": vp,
+        "vr": vr,
+        "velocity": velocity,
+        "period": period,
+        "damage": damage,
+        "dps": total / period,
+        "coolers": coolers,
+        "accuracy": accuracy,
+        "blocks": blocks,
+    }
+    if context.get('ranges') is not None:
+        engagement = calcEngagementFor(context, result)
+        result["hit"] = engagement["hit"]
+        result["delivered_dps"] = engagement["delivered_dps"]
+    if context.get('armor_layouts') is not None:
+        result.update(calcBreachFor(context, result))
+    return result
+
+
+# Max number of charger steps, checked by calcChargeCandidates for a single config
+ChargeSteps = 32
+
+
+def calcChargeCandidates(config, max_charge=None, max_blocks=None, steps=True, min_velocity=None, **kwargs):
+    """
+    Rail charge levels worth checking for a config.
+    DPS grows with charge, but rail chargers are added in steps of 100 charge per second,
+    so the best charge is either the top of some charger step, the charge limit itself,
+    or the lowest charge, which gives min_velocity.
+    Each config gets at most ChargeSteps steps. When it has more chargers, every n-th step
+    is checked, so the number of levels does not depend on the worst config of a batch.
+    @param config: weapon config with geometry
+    @param max_charge: max charge per shot
+    @param max_blocks: max number of blocks for the whole weapon
+    @param min_velocity: min shell velocity
+    @param steps: check tops of charger steps. It is not needed when only DPS matters,
+                  because the charge limit always gives the best DPS
+    @param kwargs: other weapon settings, the same as for calcCannonDataBatch
+    @returns array with charge levels. The first axis enumerates levels, other axes are broadcast from kwargs.
+             There are at most 3 + ChargeSteps levels
+    """
+    if max_charge is None and max_blocks is None:
+        raise ValueError("Rail charge search requires max_charge or max_blocks limit")
+    base = calcCannonDataBatch(config, velCharge=0, **kwargs)
+    # Charge per shot, provided by a single charger
+    step = 100 * base['period']
+    limit = np.full(np.shape(step), np.inf)
+    if max_blocks is not None:
+        chargers = np.maximum(max_blocks - base['blocks'] - 4, 0)
+        # Slightly below charger step, so ceil() does not add an extra charger
+        limit = chargers * step * (1 - 1e-9)
+    if max_charge is not None:
+        limit = np.minimum(limit, max_charge)
+    levels = [np.zeros((1,) + limit.shape), limit[np.newaxis]]
+    if min_velocity is not None:
+        # Rail velocity grows as a square root of charge
+        rail_velocity = calcCannonDataBatch(config, velCharge=1, **kwargs)['vr']
+        missing = np.maximum(min_velocity - base['vp'], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            charge = (missing / rail_velocity)**2 * (1 + 1e-9)
+        levels.append(np.minimum(charge, limit)[np.newaxis])
+    if steps:
+        # Number of charger steps for each config
+        count = np.floor(limit / step)
+        j = np.arange(1, min(int(np.max(count)), ChargeSteps) + 1).reshape((-1,) + (1,) * limit.ndim)
+        k = np.where(count > ChargeSteps, np.ceil(j * count / ChargeSteps), j)
+        levels.append(np.minimum(k * step * (1 - 1e-9), limit))
+    return np.concatenate(levels)
+
+
 MAX_DIAMETER = 0.500
 MIN_DIAMETER = 0.018
 
 
+class ShellConstraints:
+    """
+    Hard limits for weapon configs.
+    Each limit is checked at the earliest stage, where it can be evaluated, so infeasible
+    blueprints do not go through full calcCannonData:
+     - require_parts: before shell stats are calculated
+     - min_diameter, max_diameter: before geometry. In auto diameter mode shells are made
+       smaller to fit max_diameter, so only min_diameter can reject them
+     - max_blocks: right after geometry, using a lower bound without coolers and chargers
+     - max_accuracy: right after geometry
+     - min_velocity: before damage, using velocity for the max rail charge
+     - max_coolers: before damage
+     - max_blocks: the final check, when coolers and chargers are known
+    Number of skipped configs is counted for each constraint in 'skipped'.
+    """
+    Names = ['require_parts', 'min_diameter', 'max_diameter', 'max_blocks', 'max_accuracy',
+             'min_velocity', 'max_coolers']
+
+    def __init__(self, **kwargs):
+        """
+        @param require_parts: list of parts, which should be present in a blueprint
+        @param min_diameter: min shell diameter, [m]
+        @param max_diameter: max shell diameter, [m]
+        @param max_blocks: max number of blocks for the whole weapon
+        @param max_accuracy: max inaccuracy, in degrees
+        @param min_velocity: min shell velocity
+        @param max_coolers: max number of coolers
+        """
+        self.limits = {key: kwargs[key] for key in self.Names if kwargs.get(key) is not None}
+        self.skipped = {}
+
+    def get(self, name, default=None):
+        return self.limits.get(name, default)
+
+    def reset(self):
+        """Resets skip counters"""
+        self.skipped = {}
+
+    def _reject(self, name, count=1):
+        self.skipped[name] = self.skipped.get(name, 0) + int(count)
+        return False
+
+    def _applyMasks(self, feasible, checks):
+        """
+        Applies masks one by one. Masks have blueprints on axis -2, other axes are
+        for weapon settings. A blueprint is counted as skipped by the constraint, which
+        rejects its last feasible settings
+        @param checks: list of (name, mask) pairs
+        @returns resulting mask
+        """
+        def alive(mask):
+            if mask.ndim < 2:
+                return np.any(mask, keepdims=True)
+            axes = tuple(i for i in range(mask.ndim) if i != mask.ndim - 2)
+            return np.any(mask, axis=axes)
+
+        before = alive(feasible)
+        for name, mask in checks:
+            feasible = feasible & mask
+            after = alive(feasible)
+            rejected = np.count_nonzero(before & ~after)
+            if rejected:
+                self._reject(name, rejected)
+            if not np.any(after):
+                break
+            before = after
+        return feasible
+
+    def maskBlueprints(self, codes, parts):
+        """
+        Vectorized version of checkBlueprint for integer coded blueprints
+        @param codes: array with part codes, one blueprint per row
+        @param parts: list of part names for codes
+        @returns boolean mask for blueprints
+        """
+        feasible = np.ones(len(codes), dtype=bool)
+        for part in self.limits.get('require_parts', []):
+            if part in parts:
+                has_part = np.any(codes == parts.index(part), axis=1)
+            else:
+                has_part = np.zeros(len(codes), dtype=bool)
+            rejected = np.count_nonzero(feasible & ~has_part)
+            if rejected:
+                self._reject('require_parts', rejected)
+            feasible &= has_part
+        return feasible
+
+    def checkBlueprint(self, blueprint):
+        """Checks limits for a blueprint, before any calculations"""
+        required = self.limits.get('require_parts')
+        if required and any(part not in blueprint for part in required):
+            return self._reject('require_parts')
+        return True
+
+    def clampDiameter(self, diameter):
+        """
+        Limits diameter for auto diameter mode. A smaller shell still fits into the loader,
+        so max_diameter limits the diameter instead of rejecting a blueprint
+        """
+        return np.minimum(diameter, min(self.limits.get('max_diameter', MAX_DIAMETER), MAX_DIAMETER))
+
+    def checkDiameter(self, diameter):
+        """Checks diameter limits, before geometry is calculated"""
+        if 'min_diameter' in self.limits and diameter < self.limits['min_diameter']:
+            return self._reject('min_diameter')
+        if 'max_diameter' in self.limits and diameter > self.limits['max_diameter']:
+            return self._reject('max_diameter')
+        return True
+
+    def checkGeometry(self, config):
+        """Checks limits, which depend only on shell geometry and loader layout"""
+        if 'max_blocks' in self.limits:
+            # Lower bound. Coolers and rail chargers can only add more blocks
+            blocks = 1 + math.ceil(lengthForPropellant(config.get('propellant', 0), config['diameter']))
+            blocks += calcLoaderBlocks(config.get('loaders', 1), config.get('clipsPerLoader', 1),
+                                       config.get('loader_length', 1))
+            if blocks > self.limits['max_blocks']:
+                return self._reject('max_blocks')
+        if 'max_accuracy' in self.limits and calcAccuracy(config) > self.limits['max_accuracy']:
+            return self._reject('max_accuracy')
+        return True
+
+    def checkBallistics(self, config, max_charge=None):
+        """
+        Checks limits for velocity and reloading, before damage is calculated
+        @param max_charge: max rail charge, if it is searched by optimizer
+        """
+        if 'min_velocity' in self.limits:
+            context = config if max_charge is None else dict(config, velCharge=max_charge)
+            if calcTotalVelocity(context) < self.limits['min_velocity']:
+                return self._reject('min_velocity')
+        if 'max_coolers' in self.limits and calcNumberOfCoolers(config) > self.limits['max_coolers']:
+            return self._reject('max_coolers')
+        return True
+
+    def checkConfig(self, config):
+        """Final check for a config from calcCannonData"""
+        if 'max_blocks' in self.limits and config['blocks'] > self.limits['max_blocks']:
+            return self._reject('max_blocks')
+        return True
+
+    def maskLayouts(self, config, grid):
+        """
+        Vectorized version of checkDiameter and checkGeometry for a grid of loader layouts.
+        @param config: weapon config or stacked configs, with blueprints on axis -2
+        @param grid: loader layouts from makeLoaderTable with 'diameter' column
+        @returns boolean mask for blueprints and layouts
+        """
+        diameter = grid['diameter']
+        shape = np.broadcast_shapes(np.shape(diameter), np.shape(grid['loaderBlocks']))
+        checks = []
+        if 'min_diameter' in self.limits:
+            checks.append(('min_diameter', diameter >= self.limits['min_diameter']))
+        if 'max_diameter' in self.limits:
+            checks.append(('max_diameter', diameter <= self.limits['max_diameter']))
+        if 'max_blocks' in self.limits:
+            barrel = np.ceil(lengthForPropellant(config.get('propellant', 0), diameter))
+            checks.append(('max_blocks', 1 + barrel + grid['loaderBlocks'] <= self.limits['max_blocks']))
+        return self._applyMasks(np.ones(shape, dtype=bool), checks)
+
+    def maskBatch(self, data, settings, check_length=True, feasible=True):
+        """
+        Vectorized version of all checks for data from calcCannonDataBatch
+        @param settings: weapon settings, used to calculate data
+        @param check_length: check if shell fits into autoloader
+        @param feasible: mask from previous checks
+        @returns boolean mask
+        """
+        checks = []
+        if check_length:
+            checks.append(('loader_length', data['length'] <= settings['loader_length'] + 1e-9))
+        if 'max_accuracy' in self.limits:
+            checks.append(('max_accuracy', data['accuracy'] <= self.limits['max_accuracy']))
+        if 'min_velocity' in self.limits:
+            checks.append(('min_velocity', data['velocity'] >= self.limits['min_velocity']))
+        if 'max_coolers' in self.limits:
+            checks.append(('max_coolers', data['coolers'] <= self.limits['max_coolers']))
+        if 'max_blocks' in self.limits:
+            checks.append(('max_blocks', data['blocks'] <= self.limits['max_blocks']))
+        return self._applyMasks(np.broadcast_to(feasible, np.shape(data['dps'])), checks)
+
+
+def calcCandidates(config, settings, constraints, feasible=True, check_length=True):
+    """
+    Evaluates a batch of blueprints with a grid of weapon settings and checks constraints
+    @param config: stacked configs with blueprints on axis -2
+    @param settings: weapon settings, including diameter and velCharge, which broadcast with config
+    @param constraints: ShellConstraints
+    @param feasible: mask from previous checks, like maskLayouts
+    @param check_length: check if shell fits into autoloader
+    @returns (fields, feasible): dict with config, settings and data from calcCannonDataBatch,
+             and boolean mask for candidates
+    """
+    data = calcCannonDataBatch(config, **settings)
+    # Shell needs propellant or rail charge to fly
+    feasible = feasible & ((np.asarray(config.get('propellant', 0)) > 0) | (np.asarray(settings['velCharge']) > 0))
+    feasible = constraints.maskBatch(data, settings, check_length, feasible)
+    fields = dict(config)
+    fields.update(settings)
+    fields.update(data)
+    return fields, feasible
+
+
+# Max number of values in arrays for a single batch of blueprints
+BatchElements = 2**20
+
+# Approximate memory for a single candidate in a batch, including all temporary arrays
+BytesPerElement = 256
+
+# Default memory limit for batch evaluation
+DefaultMemoryLimit = BatchElements * BytesPerElement
+
+
+def calcCandidateWidth(config):
+    """
+    Memory for a single candidate, relative to a plain weapon config.
+    Engagement and breach fields add arrays with an extra axis for target ranges and armor layouts
+    @param config: weapon config with 'ranges' and 'armor_layouts', if they are used
+    """
+    return 1 + len(config.get('ranges') or ()) + len(config.get('armor_layouts') or ())
+
+# Number of blueprints between progress reports in calcBestShells, for the slow path and the batch path
+ProgressPeriod = 1024
+ProgressChunk = 16384
+
+
+def blueprintChunks(max_modules, size, atlas=None):
+    """
+    Iterates over chunks of blueprints. Blueprints are taken from atlas if it is available,
+    otherwise they are enumerated and their stats are calculated on the fly.
+    Blueprints from atlas can have more modules than max_modules.
+    @param max_modules: max number of modules in a blueprint
+    @param size: number of blueprints in a chunk
+    @param atlas: BlueprintAtlas
+    @returns generator for (start, codes, columns), see calcBulletColumns
+    """
+    if atlas is not None:
+        for start in range(0, len(atlas), size):
+            stop = min(start + size, len(atlas))
+            yield start, atlas.codes(start, stop), atlas.columns(start, stop)
+        return
+    start = 0
+    chunk = []
+    for blueprint in allBodyGen(max_modules):
+        chunk.append(blueprint)
+        if len(chunk) == size:
+            yield (start,) + calcBulletColumns(chunk, max_modules)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield (start,) + calcBulletColumns(chunk, max_modules)
+
+
 class ShellOptimizer:
     """
     This class provides sheel optimization routines
     """
+    # Named objectives
+    Objectives = {
+        'dps': 'dps',
+        'dps_per_block': 'dps / blocks',
+        'delivered_dps': 'delivered_dps',
+        'breach_time': '1 / breach_time',
+    }
+
     def __init__(self, **kwargs):
         """
         @param loader_length: length of autoloader
         @param max_modules: max shell modules to be used
         @param max_results: number of results to be uploaded
-        @param score_fn: function to calculate a score to generated config
+        @param score_fn: score for generated configs. It can be a python function, or a score expression
+                         like "dps if velocity >= 50 else -1". Expressions are evaluated for whole batches
+                         of candidates. Configs with score <= 0 are dropped
+        @param max_blocks: block budget for the whole weapon
+        @param objective: what to maximize when searching for rail charge and loader layout: 'dps', 'dps_per_block',
+                          'delivered_dps' or a score expression. Score expression from score_fn is used by default.
+                          Engagement fields 'hit' and 'delivered_dps' require target 'ranges' in calcBestShells.
+                          'breach_time' objective minimizes time to breach 'armor_layouts'
+        @param atlas: BlueprintAtlas with precalculated blueprints. Blueprints are enumerated if it is not set
+        @param memory_limit: approximate memory limit for batch evaluation, in bytes. Blueprints are
+                             evaluated in chunks, which fit into this limit
+        Hard limits from ShellConstraints can be passed here as well: require_parts, min_diameter, max_diameter,
+        max_accuracy, min_velocity, max_coolers. Skip counts for the last run are stored in 'skipped'.
+        Blueprints, which passed all constraints but got no positive objective, are counted in 'score_rejected'
         """
         # Max module number to be optimized
         self.max_modules = kwargs.get('max_modules', 4)
         # Maximum number of reported results per optimization run
         self.max_results = kwargs.get('max_results', 4)
         # Score/filter function
-        self.score_fn = kwargs.get('score_fn', None)
+        self.score_fn = makeScoreFn(kwargs.get('score_fn', None))
         self.diameter = kwargs.get('diameter', 'auto')
+        # Block budget
+        self.max_blocks = kwargs.get('max_blocks', None)
+        # Objective for searching weapon settings
+        objective = kwargs.get('objective', None)
+        if objective is None:
+            objective = self.score_fn if isinstance(self.score_fn, ScoreExpression) else 'dps'
+        self.objective = makeScoreFn(self.Objectives.get(objective, objective))
+        if not isinstance(self.objective, ScoreExpression):
+            raise ValueError("Objective should be a score expression: %s" % str(objective))
+        self.constraints = ShellConstraints(**kwargs)
+        # Precalculated blueprints
+        self.atlas = kwargs.get('atlas', None)
+        if self.atlas is not None and self.atlas.max_modules < self.max_modules:
+            raise ValueError("Atlas is built for %d modules, but %d modules are requested"
+                             % (self.atlas.max_modules, self.max_modules))
+        # Memory limit for batch evaluation, in bytes
+        self.memory_limit = kwargs.get('memory_limit', DefaultMemoryLimit)
+        # Number of blueprints without positive objective during the last run
+        self.score_rejected = 0
+
+    @property
+    def skipped(self):
+        """Number of configs, skipped by each constraint during the last run"""
+        return self.constraints.skipped
+
+    def _parts(self):
+        """Part names for integer coded blueprints"""
+        return self.atlas.parts if self.atlas is not None else ShellParts
+
+    def _blueprintChunks(self, size):
+        """
+        Iterates over chunks of blueprints. Blueprints are taken from atlas if it is available,
+        otherwise they are enumerated and their stats are calculated on the fly.
+        Blueprints from atlas can have more modules than max_modules.
+        @param size: number of blueprints in a chunk
+        @returns generator for (start, codes, columns), see calcBulletColumns
+        """
+        return blueprintChunks(self.max_modules, size, self.atlas)
+
+    def _blueprintConfigs(self):
+        """
+        Iterates over all blueprints with up to max_modules modules
+        @returns generator for (index, config), config is the same as from calcBulletStats
+        """
+        parts = self._parts()
+        for start, codes, columns in self._blueprintChunks(65536):
+            for row in np.flatnonzero(columns['modules'] <= self.max_modules):
+                config = configFromColumns(columns, row)
+                config['shell'] = decodeBlueprint(codes[row], parts)
+                yield start + row, config
+
+    def _searchBatch(self, config, diameter, table, vel_charge, max_charge, check_length=True):
+        """
+        Finds the best rail charge and loader layout for a batch of blueprints.
+        Arrays for calculations have shape (charges, blueprints, layouts).
+        @param config: weapon config for a single blueprint, or stacked configs with shape (blueprints, 1)
+        @param diameter: diameters with shape (blueprints, layouts)
+        @param table: loader layouts from makeLoaderTable
+        @param check_length: check if shell fits into autoloader
+        @returns dict with arrays for blueprints, which have some feasible settings:
+         - rows - index of the blueprint in the batch
+         - layout - index of the best loader layout
+         - velCharge, diameter - the best settings
+         - objective - value of the objective
+         - score - value of score_fn, if it is a score expression
+        """
+        empty = {key: np.zeros(0) for key in ['velCharge', 'diameter', 'objective', 'score']}
+        empty.update(rows=np.zeros(0, dtype=int), layout=np.zeros(0, dtype=int))
+        grid = {key: value[np.newaxis] for key, value in table.items()}
+        grid['diameter'] = diameter
+        # Cheap checks, before anything is calculated for a shell
+        feasible = self.constraints.maskLayouts(config, grid)
+        rows = np.flatnonzero(np.any(feasible, axis=1))
+        if len(rows) == 0:
+            return empty
+        if len(rows) < len(feasible):
+            # Only blueprint columns are stacked, other values are the same for all blueprints
+            config = dict(config)
+            config.update({key: config[key][rows] for key in BulletColumns if key in config})
+            grid['diameter'] = diameter[rows]
+            feasible = feasible[rows]
+
+        if isinstance(vel_charge, str):
+            charges = calcChargeCandidates(config, max_charge, self.max_blocks,
+                                           steps='blocks' in self.objective.fields,
+                                           min_velocity=self.constraints.get('min_velocity'), **grid)
+        else:
+            charges = np.reshape(np.asarray(vel_charge, dtype=float), (-1, 1, 1))
+            if max_charge is not None:
+                charges = charges[charges[:, 0, 0] <= max_charge]
+        if len(charges) == 0:
+            return empty
+        fields, feasible = calcCandidates(config, dict(grid, velCharge=charges), self.constraints,
+                                          feasible, check_length)
+        shape = np.broadcast_shapes(feasible.shape, np.shape(fields['dps']), charges.shape)
+        count = shape[1]
+
+        def flatten(values):
+            # (charges, blueprints, layouts) -> (blueprints, charges * layouts)
+            return np.moveaxis(np.broadcast_to(values, shape), 1, 0).reshape(count, -1)
+
+        objective = self.objective.evaluate(scoreFields(fields, self.objective.fields))
+        objective = flatten(np.where(feasible, objective, -np.inf))
+        best = np.argmax(objective, axis=1)
+        index = np.arange(count)
+        value = objective[index, best]
+        positive = value > 0
+        self.score_rejected += int(np.count_nonzero(np.isfinite(value) & ~positive))
+
+        if self.score_fn is self.objective:
+            score = value
+        elif isinstance(self.score_fn, ScoreExpression):
+            score = flatten(self.score_fn.evaluate(scoreFields(fields, self.score_fn.fields)))[index, best]
+        else:
+            score = np.full(count, np.nan)
+        layout = best % shape[2]
+        return {
+            "rows": rows[positive],
+            "layout": layout[positive],
+            "velCharge": flatten(charges)[index, best][positive],
+            "diameter": grid['diameter'][index, layout][positive],
+            "objective": value[positive],
+            "score": score[positive],
+        }
+
+    def _settings(self, found, i, table):
+        """Weapon settings for i-th blueprint from _searchBatch"""
+        layout = found['layout'][i]
+        settings = {key: table[key][layout].item() for key in LoaderSearchKeys}
+        settings['diameter'] = float(found['diameter'][i])
+        settings['velCharge'] = float(found['velCharge'][i])
+        return settings
+
+    def _searchGrid(self, config, diameter, table, vel_charge, max_charge):
+        """
+        Finds the best rail charge and loader layout for a config
+        @param diameter: diameter for each layout from the table
+        @returns (settings, objective) for the best weapon settings or None if nothing fits
+        """
+        found = self._searchBatch(config, np.reshape(diameter, (1, -1)), table, vel_charge, max_charge)
+        if len(found['rows']) == 0:
+            return None
+        return self._settings(found, 0, table), float(found['objective'][0])
+
+    def countBlueprints(self):
+        """
+        Number of blueprints to be checked by calcBestShells. It is the total for progress reports
+        """
+        if self.atlas is not None:
+            return len(self.atlas)
+        return countAllBodies(self.max_modules)
+
+    def _calcBestBatch(self, kwargs, vel_charge, max_charge, can_charge, loader_search, progress=None):
+        """
+        Batched version of calcBestShells for score expressions.
+        Blueprints are evaluated in chunks, so only the best configs go through calcCannonData.
+        """
+        constraints = self.constraints
+        diameter_mode = self.diameter
+        kwargs = dict(kwargs)
+        kwargs.pop('velCharge', None)
+        kwargs.setdefault('loader_length', 1)
+        table = makeLoaderTable(**{key: kwargs.pop(key) for key in LoaderSearchKeys if key in kwargs})
+        if not isinstance(vel_charge, str):
+            vel_charge = np.atleast_1d(vel_charge)
+            levels = len(vel_charge)
+        else:
+            # Zero, limit, min velocity and charger steps, the same as calcChargeCandidates returns
+            levels = 3 + (ChargeSteps if 'blocks' in self.objective.fields else 0)
+        layouts = len(table['loaders'])
+        parts = self._parts()
+
+        # Heap with (score, index, (codes, settings)) for the best results
+        best = []
+        chunk_size = max(1, self.memory_limit // (BytesPerElement * calcCandidateWidth(kwargs) * layouts * levels))
+        if progress is not None:
+            chunk_size = min(chunk_size, ProgressChunk)
+        for start, codes, columns in self._blueprintChunks(chunk_size):
+            rows = np.flatnonzero(columns['modules'] <= self.max_modules)
+            rows = rows[constraints.maskBlueprints(codes[rows], parts)]
+            if not can_charge:
+                rows = rows[columns['propellant'][rows] > 0]
+            if len(rows) == 0:
+                continue
+            config = dict(kwargs)
+            config.update({key: np.asarray(columns[key][rows], dtype=float)[:, np.newaxis] for key in BulletColumns})
+
+            if diameter_mode == 'auto':
+                # The same as in calcBestShells: max possible diameter, or the lowest one for rail-only shells
+                diameter = table['loader_length'][np.newaxis] / config['modules']
+                if can_charge:
+                    diameter = np.where(config['propellant'] == 0, MIN_DIAMETER, diameter)
+                diameter = constraints.clampDiameter(diameter)
+            else:
+                diameter = diameter_mode
+            diameter = np.clip(np.broadcast_to(diameter, (len(rows), layouts)), MIN_DIAMETER, MAX_DIAMETER)
+
+            found = self._searchBatch(config, diameter, table, vel_charge, max_charge, loader_search)
+            # Only the best configs of a chunk can get into results
+            for i in np.argsort(found['score'], kind='stable')[-self.max_results:]:
+                score = float(found['score'][i])
+                if score <= 0:
+                    continue
+                row = rows[found['rows'][i]]
+                item = (score, start + row, (codes[row], self._settings(found, i, table)))
+                if len(best) < self.max_results:
+                    heapq.heappush(best, item)
+                else:
+                    heapq.heappushpop(best, item)
+            if progress is not None and progress(start + len(codes), lambda: self._batchResults(best, kwargs)) is False:
+                break
+
+        return self._batchResults(best, kwargs)
+
+    def _batchResults(self, best, kwargs):
+        """Calculates weapon configs for the best items from _calcBestBatch"""
+        results = []
+        for score, index, (code, settings) in sorted(best):
+            config = dict(calcBulletStats(decodeBlueprint(code, self._parts())), **kwargs)
+            config.update(settings)
+            calcBulletGeometry(config, config['diameter'])
+            calcCannonData(config)
+            results.append(config)
+        return results
 
     def calcBestShells(self, **kwargs):
         """
         Finds the best weapon config for specified weapon limits
+        @param velCharge: rail charge per shot. It can be a number, a list of charge levels to be
+                          searched, or 'auto' to find the best charge, limited by max_charge and max_blocks
+        @param max_charge: max rail charge per shot, used for charge search
+        @param loaders, clipsPerLoader, belt, loader_length: loader layout. Each of them can be
+                          a number or a list of values. All combinations of listed values are searched
+                          for the best layout. Shells, which do not fit into autoloader, are skipped.
+        @param progress: function progress(done, results), which is called from time to time during the search.
+                         'done' is the number of checked blueprints, see countBlueprints, and 'results' is
+                         a function, which returns the best configs found so far. The search is stopped
+                         if it returns False, and the best configs found so far are returned
+        @param ranges: list of target ranges. Hit probability and expected delivered DPS are calculated
+                       for these ranges, see calcEngagementFor. target_size, target_accel and range_weights
+                       can be set as well
+        @param armor_layouts: list of armor layouts, like [['metal', 'HA'], ['alloy'] * 4].
+                              Shots and time to breach them are calculated, see calcBreachFor
+        All other arguments are copied to weapon config
         """
+        # Heap with (score, index, config) for the best results
         best = []
-        current = []
         scoreFn = self.score_fn
         diameter_mode = self.diameter
-        
-        if scoreFn is None:
-            scoreFn = lambda a: a["dps"]
 
-        vel_charge = kwargs.get('velCharge', 0)
+        constraints = self.constraints
+        constraints.reset()
+        self.score_rejected = 0
 
-        for blueprint in allBodyGen(self.max_modules):
-            config = dict(calcBulletStats(blueprint), **kwargs)
-            if 'loader_length' not in config:
+        for fn in (self.objective, scoreFn):
+            if not isinstance(fn, ScoreExpression):
+                continue
+            if kwargs.get('ranges') is None and fn.fields.intersection(EngagementFields):
+                raise ValueError("Target ranges are required for %s" % repr(fn))
+            if kwargs.get('armor_layouts') is None and fn.fields.intersection(BreachFields):
+                raise ValueError("Armor layouts are required for %s" % repr(fn))
+
+        vel_charge = kwargs.get('velCharge', 0)
+        max_charge = kwargs.pop('max_charge', None)
+        progress = kwargs.pop('progress', None)
+        charge_search = isinstance(vel_charge, str) or np.ndim(vel_charge) > 0
+        if isinstance(vel_charge, str):
+            if vel_charge != 'auto':
+                raise ValueError("Unknown velCharge mode: %s" % vel_charge)
+            can_charge = max_charge is None or max_charge > 0
+        elif charge_search:
+            can_charge = np.any(np.asarray(vel_charge) > 0)
+        else:
+            can_charge = vel_charge > 0
+
+        loader_search = any(np.ndim(kwargs.get(key)) > 0 for key in LoaderSearchKeys)
+        if isinstance(scoreFn, ScoreExpression):
+            return self._calcBestBatch(kwargs, vel_charge, max_charge, can_charge, loader_search, progress)
+
+        # Slow path for python score functions: each config is evaluated separately
+        search = charge_search or loader_search
+        if search:
+            kwargs.pop('velCharge', None)
+            kwargs.setdefault('loader_length', 1)
+            layout = {key: kwargs.pop(key) for key in LoaderSearchKeys if key in kwargs}
+            # Period and block tables for all loader layouts
+            table = makeLoaderTable(**layout)
+
+        reported = 0
+        for index, stats in self._blueprintConfigs():
+            if progress is not None and index - reported >= ProgressPeriod:
+                reported = index
+                if progress(index, lambda: [config for score, index, config in sorted(best)]) is False:
+                    break
+            if not constraints.checkBlueprint(stats['shell']):
+                continue
+            config = dict(stats, **kwargs)
+            if 'loader_length' not in config and not search:
                 config['loader_length'] = 1
-            if vel_charge == 0 and config.get('propellant', 0) == 0:
+            if not can_charge and config.get('propellant', 0) == 0:
                 continue
                 
             modules = config.get("modules", 1)
@@ -625,29 +1492,50 @@ class ShellOptimizer:
                 # TODO: check if there are only rail blocks. Then we will take lowest diameter possible
                 # We are trying to get max possible diameter for the shell. Some modules have a limit for max diameter,
                 # so this calculation can provide us a bit smaller shell than it could be
-                if vel_charge > 0 and config.get('propellant', 0) == 0:
+                if can_charge and config.get('propellant', 0) == 0:
                     diameter = MIN_DIAMETER
+                elif search:
+                    diameter = table['loader_length'] / modules
                 else:
                     diameter = float(config['loader_length']) / modules
+                diameter = constraints.clampDiameter(diameter)
             else:
                 diameter = diameter_mode
+
+            if search:
+                diameter = np.clip(np.broadcast_to(diameter, table['loaders'].shape), MIN_DIAMETER, MAX_DIAMETER)
+                found = self._searchGrid(config, diameter, table, vel_charge, max_charge)
+                if found is None:
+                    continue
+                settings, objective = found
+                config.update(settings)
+                diameter = config['diameter']
                 
             if diameter > MAX_DIAMETER:
                 diameter = MAX_DIAMETER
             if diameter < MIN_DIAMETER:
                 diameter = MIN_DIAMETER
 
+            if not search and not constraints.checkDiameter(diameter):
+                continue
             calcBulletGeometry(config, diameter)
+            if not search:
+                if not constraints.checkGeometry(config) or not constraints.checkBallistics(config):
+                    continue
             calcCannonData(config)
 
-            if scoreFn(config) > 0:
-                current.append(config)
+            if not constraints.checkConfig(config):
+                continue
 
-            if len(current) > self.max_results: 
-                best = sorted(best + current, key=scoreFn)[-self.max_results:]
-                current = []
+            score = scoreFn(config)
+            if score <= 0:
+                continue
+            if len(best) < self.max_results:
+                heapq.heappush(best, (score, index, config))
+            else:
+                heapq.heappushpop(best, (score, index, config))
 
-        return sorted(best + current, key=scoreFn)[-self.max_results:]
+        return [config for score, index, config in sorted(best)]
 
     
 def calcBestShells(loaderLength, maxModules, batch, context, scoreFn=None):
@@ -701,13 +1589,18 @@ def is_accurate(val_a, val_b, accuracy=2.0):
 
 
 # Run verification for real game data
-def run_verification(dataset):
+# Blueprint stats are taken from atlas, if it is provided
+def run_verification(dataset, atlas=None):
     miscalculated = 0
     for reference_data in dataset:
         diameter = reference_data['diameter']
         blueprint = reference_data['shell']
         charge = reference_data.get('charge', 0)
-        config = calcBulletStats(blueprint, diameter)
+        index = atlas.find(blueprint) if atlas is not None else None
+        if index is not None:
+            config = atlas.stats(index, diameter)
+        else:
+            config = calcBulletStats(blueprint, diameter)
         config['velCharge'] = charge
         calcCannonData(config)
         report = []
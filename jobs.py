@@ -0,0 +1,138 @@
+"""
+This file contains background optimizer jobs for notebooks.
+
+A job runs ShellOptimizer.calcBestShells in a background thread, so the notebook kernel
+stays responsive. Results table is displayed once and is updated in place while
+the best results improve:
+    job = OptimizerJob(optimizer, loader_length=2, velCharge='auto', max_charge=5000)
+    job.progress    # part of blueprints checked
+    job.cancel()    # stop the search, keeping the best results found so far
+    job.wait()      # wait for results
+Several jobs can run at the same time. Each job uses its own copy of the optimizer,
+so skip counts of different jobs do not mix. Batch evaluation spends most of the time
+in numpy, which releases GIL, so threads share CPU well enough.
+"""
+import copy
+import threading
+import time
+from IPython.display import HTML, display
+from report import formatTable
+
+
+class OptimizerJob:
+    """
+    Background run of ShellOptimizer.calcBestShells
+    """
+    def __init__(self, optimizer, columns=None, name=None, show=True, update_period=0.5, **kwargs):
+        """
+        Starts the job
+        @param optimizer: ShellOptimizer
+        @param columns: columns for results table, see report.displayTable
+        @param name: job name for results table
+        @param show: display results table, which is updated while the job runs
+        @param update_period: min time between table updates, in seconds
+        @param kwargs: arguments for calcBestShells
+        """
+        self.optimizer = copy.copy(optimizer)
+        self.optimizer.constraints = copy.deepcopy(optimizer.constraints)
+        self.kwargs = kwargs
+        self.columns = columns
+        self.name = name if name is not None else "Job %s" % ", ".join("%s=%s" % item for item in kwargs.items())
+        self.update_period = update_period
+        # Best results found so far
+        self.results = []
+        # Exception, if the job has failed
+        self.error = None
+        # Number of checked blueprints and total number of blueprints
+        self.done = 0
+        self.total = None
+        self.started = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+        self._updated = 0
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._handle = display(HTML(self._html()), display_id=True) if show else None
+        self._thread.start()
+
+    def __repr__(self):
+        return "<OptimizerJob '%s': %s, %.0f%%>" % (self.name, self.status, self.progress * 100)
+
+    @property
+    def status(self):
+        """Job status: running, cancelling, cancelled, failed or finished"""
+        if self.error is not None:
+            return 'failed'
+        if self.finished is None:
+            return 'cancelling' if self._cancel.is_set() else 'running'
+        return 'cancelled' if self._cancel.is_set() else 'finished'
+
+    @property
+    def progress(self):
+        """Part of checked blueprints, from 0 to 1"""
+        if self.status == 'finished':
+            return 1.0
+        if not self.total:
+            return 0.0
+        return min(self.done / self.total, 1.0)
+
+    @property
+    def skipped(self):
+        """Skip counts for constraints, see ShellOptimizer.skipped"""
+        return self.optimizer.skipped
+
+    def cancel(self):
+        """
+        Stops the job. Best results found so far are kept
+        """
+        if self.finished is None:
+            self._cancel.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the job to finish
+        @param timeout: max time to wait, in seconds
+        @returns best results
+        """
+        self._thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def _run(self):
+        try:
+            self.total = self.optimizer.countBlueprints()
+            self.results = self.optimizer.calcBestShells(progress=self._progress, **self.kwargs)
+            if not self._cancel.is_set():
+                self.done = self.total
+        except Exception as e:
+            self.error = e
+        self.finished = time.time()
+        self._update()
+
+    def _progress(self, done, results):
+        """Progress callback for calcBestShells"""
+        self.done = done
+        now = time.time()
+        if now - self._updated >= self.update_period:
+            self._updated = now
+            self.results = results()
+            self._update()
+        return not self._cancel.is_set()
+
+    def _update(self):
+        if self._handle is not None:
+            self._handle.update(HTML(self._html()))
+
+    def _html(self):
+        elapsed = (self.finished or time.time()) - self.started
+        if self.total is None:
+            # Total is not known yet, only checked blueprints are shown
+            checked = '{} blueprints'.format(self.done)
+        else:
+            checked = '{}/{} blueprints ({:.0f}%)'.format(self.done, self.total, self.progress * 100)
+        status = '<b>{}</b>: {}, {}, {:.1f}s'.format(self.name, self.status, checked, elapsed)
+        if self.error is not None:
+            status += '</br>{}: {}'.format(type(self.error).__name__, self.error)
+        if not self.results:
+            return status
+        return status + formatTable(self.results, self.columns)
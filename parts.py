@@ -0,0 +1,156 @@
+"""
+This file contains shell part registry.
+
+Each part gets a small integer id, and all part attributes are stored in numpy arrays,
+indexed by this id. Part values are loaded from parts.json, so new game values need no code edits.
+Blueprints are converted to integer codes once, and all stats are calculated from codes:
+    codes = FTD.encodeBlueprints(blueprints, width)
+    columns = Parts.calcColumns(codes)
+
+Part attributes:
+ - name - part name, used in blueprints
+ - speed, ap, kinetic - speed, armor piercing and kinetic modifiers
+ - length - max length of the module, in meters. Modules are as long as diameter by default
+ - tail - part belongs to the tail section. Modifiers are calculated for parts above the tail
+ - casing - part is not counted in shell length
+ - count - config value, which counts this part, like 'numExplosive'
+ - expMod - explosive modifier for the whole shell
+ - speedBonus - speed bonus for the whole shell. It is applied once
+"""
+import hashlib
+import json
+import os
+import numpy as np
+
+
+DefaultPartsFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parts.json')
+
+# Default values of part attributes
+PartDefaults = {
+    'speed': 1.0,
+    'ap': 1.0,
+    'kinetic': 1.0,
+    'length': 1.0,
+    'tail': False,
+    'casing': None,
+    'count': None,
+    'expMod': 1.0,
+    'speedBonus': 0.0,
+}
+
+# Modifier for empty slots of short shells in AP and kinetic modifiers
+EmptySlotMod = 0.5
+
+
+class PartRegistry:
+    """
+    Shell parts with their attributes, stored in arrays
+    """
+    def __init__(self, data):
+        """
+        @param data: dict with 'parts' list, like in parts.json
+        """
+        parts = [dict(PartDefaults, **part) for part in data['parts']]
+        # Part names, index is part id
+        self.names = [part['name'] for part in parts]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        if len(self.ids) != len(self.names):
+            raise ValueError("Duplicate part names in registry")
+        self.speed = np.array([part['speed'] for part in parts], dtype=float)
+        self.ap = np.array([part['ap'] for part in parts], dtype=float)
+        self.kinetic = np.array([part['kinetic'] for part in parts], dtype=float)
+        self.length = np.array([part['length'] for part in parts], dtype=float)
+        self.tail = np.array([part['tail'] for part in parts], dtype=bool)
+        self.casing = np.array([part['tail'] if part['casing'] is None else part['casing'] for part in parts],
+                               dtype=bool)
+        self.expMod = np.array([part['expMod'] for part in parts], dtype=float)
+        self.speedBonus = np.array([part['speedBonus'] for part in parts], dtype=float)
+        # Config values, which count parts, and index of counter for each part
+        self.counters = sorted(set(part['count'] for part in parts if part['count'] is not None))
+        self.counter = np.array([self.counters.index(part['count']) if part['count'] is not None else -1
+                                 for part in parts], dtype=int)
+        # Version of part values. Caches with precalculated stats should be keyed by it
+        text = json.dumps(data['parts'], sort_keys=True).encode('utf-8')
+        self.fingerprint = hashlib.sha1(text).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def id(self, name):
+        """Part id for a name"""
+        if name not in self.ids:
+            raise ValueError("Unknown shell part: %s" % name)
+        return self.ids[name]
+
+    def table(self, values):
+        """
+        Part values as a dict, keyed by part names
+        @param values: array with part values, like self.speed
+        """
+        return {name: values[i].item() for i, name in enumerate(self.names)}
+
+    def calcColumns(self, codes):
+        """
+        Calculates diameter-independent stats for integer coded blueprints.
+        It is the same as calcBulletStats, but for the whole array of blueprints at once
+        @param codes: int array with one blueprint per row, padded by -1
+        @returns dict with arrays: speedC, armorC, kineticC, expMod, modules and counters
+        """
+        codes = np.asarray(codes)
+        if codes.shape[1] < 3:
+            # Modifiers are averaged over at least 3 slots
+            padding = np.full((codes.shape[0], 3 - codes.shape[1]), -1, dtype=codes.dtype)
+            codes = np.concatenate([codes, padding], axis=1)
+        valid = codes >= 0
+        part = np.where(valid, codes, 0)
+        width = codes.shape[1]
+        slots = np.arange(width)
+
+        # Number of parts above the tail
+        stop = self.tail[part] | ~valid
+        size = np.where(np.any(stop, axis=1), np.argmax(stop, axis=1), width)[:, np.newaxis]
+        body = slots < size
+        weight = 0.75**slots
+
+        # Speed modifier, weighted by slot
+        up = np.sum(self.speed[part] * weight * body, axis=1)
+        down = np.sum(weight * body, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(down > 0, up / down, 1.0)
+        speed = speed * (1 + np.max(self.speedBonus[part] * valid, axis=1))
+
+        # AP and kinetic modifiers use at least 3 slots, empty ones have a fixed modifier
+        slot = slots < np.maximum(size, 3)
+        ap = np.where(body, self.ap[part], EmptySlotMod) * slot
+        armor = np.sum(ap * weight, axis=1) / np.sum(weight * slot, axis=1)
+        kinetic = np.where(body, self.kinetic[part], EmptySlotMod) * slot
+        kinetic = np.sum(kinetic, axis=1) / np.sum(slot, axis=1)
+
+        columns = {
+            'speedC': speed,
+            'armorC': armor,
+            'kineticC': kinetic,
+            'expMod': np.min(np.where(valid, self.expMod[part], 1.0), axis=1),
+            'modules': np.count_nonzero(valid, axis=1),
+        }
+        counter = np.where(valid, self.counter[part], -1)
+        for i, key in enumerate(self.counters):
+            columns[key] = np.count_nonzero(counter == i, axis=1)
+        return columns
+
+
+def loadParts(path=DefaultPartsFile):
+    """
+    Loads part registry from a file
+    @param path: path to json file, like parts.json
+    @returns PartRegistry
+    """
+    with open(path) as file:
+        return PartRegistry(json.load(file))
+
+
+# Default part registry
+Parts = loadParts()
@@ -28,6 +28,14 @@ def displayTable(results, columns=None):
     @param results - a list with results, obtained from calcBestShells
     @param columns:list - a list of column names to be displayed
     """
+    return display(HTML(formatTable(results, columns)))
+
+
+def formatTable(results, columns=None):
+    """
+    Generates HTML code of results table, see displayTable
+    @returns string with HTML table
+    """
     if columns is None:
         columns = ["dps", "damage", "diameter", "velocity", "period", "blocks", "shell"]
     # Row start - caption
@@ -40,7 +48,7 @@ def displayTable(results, columns=None):
         rows.append('<td>{}</td>'.format(line))
 
     htmlData = '</tr><tr>'.join(rows)
-    return display(HTML('<table><tr>' + caption + '</tr><tr>' + htmlData + '</tr></table>'))
+    return '<table><tr>' + caption + '</tr><tr>' + htmlData + '</tr></table>'
 
 
 def BBcode_formatValue(key, value):
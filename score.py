@@ -0,0 +1,182 @@
+"""
+This file contains score expressions for weapon configs.
+
+A score expression is a short formula over result fields, like:
+    dps if velocity >= 50 else -1
+    min(dps, 2000) / blocks - 10 * coolers
+It is compiled once to numpy operations, so the same score can be evaluated for a single
+config from calcCannonData or for a whole batch of candidates from calcCannonDataBatch.
+"""
+import ast
+import operator
+import numpy as np
+
+
+# Plain fields of weapon config, which can be used in score expressions
+ResultFields = ['dps', 'velocity', 'vp', 'vr', 'blocks', 'accuracy', 'coolers', 'period',
+                'diameter', 'velCharge', 'loaders', 'clipsPerLoader', 'loader_length',
+                'modules', 'propellant', 'rails', 'numExplosive', 'numFlak',
+                'numFrag', 'numSquash', 'numShaped', 'armor']
+
+# Engagement stats, which are available when weapon config has target 'ranges', see engagement.py
+EngagementFields = ['hit', 'delivered_dps']
+
+# Time to breach, which is available when weapon config has 'armor_layouts', see armor.py
+BreachFields = ['breach_shots', 'breach_time']
+
+# Damage components. Each of them gives two fields: damage and its AP, like 'kinetic' and 'kinetic_ap'
+DamageFields = ['kinetic', 'HE', 'flak', 'frag', 'squash', 'spall', 'shaped']
+
+BinaryOps = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+
+CompareOps = {
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+
+def _reduce(fn):
+    def reduced(*args):
+        result = args[0]
+        for arg in args[1:]:
+            result = fn(result, arg)
+        return result
+    return reduced
+
+
+Functions = {
+    'min': _reduce(np.minimum),
+    'max': _reduce(np.maximum),
+    'abs': np.abs,
+}
+
+
+def scoreFields(result, names=None):
+    """
+    Collects fields for score expressions from a result of calcCannonData or calcCannonDataBatch.
+    Missing fields are 0
+    @param names: names of fields to be collected. All fields are collected by default
+    """
+    if names is None:
+        names = ResultFields + EngagementFields + BreachFields + DamageFields + [name + '_ap' for name in DamageFields]
+    damage = result.get('damage', {})
+    fields = {}
+    for name in names:
+        if name in result:
+            fields[name] = result[name]
+        elif name in damage:
+            fields[name] = damage[name][0]
+        elif name.endswith('_ap') and name[:-3] in damage:
+            fields[name] = damage[name[:-3]][1]
+        else:
+            fields[name] = 0
+    return fields
+
+
+class ScoreExpression:
+    """
+    Score function, defined by an expression over result fields.
+    Supported syntax: numbers, field names, + - * / **, comparisons, and/or/not,
+    'a if condition else b', min(), max() and abs().
+    It can be used as score_fn for ShellOptimizer, or called for a single config.
+    """
+    def __init__(self, expression):
+        """
+        @param expression: expression string, like "dps if velocity >= 50 else -1"
+        """
+        self.expression = expression
+        # Names of fields, used by this expression
+        self.fields = set()
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError("Invalid score expression '%s': %s" % (expression, e.msg))
+        self._fn = self._compile(tree.body)
+
+    def __repr__(self):
+        return "ScoreExpression(%r)" % self.expression
+
+    def __call__(self, result):
+        """
+        Calculates score for a single result from calcCannonData
+        """
+        return float(self.evaluate(scoreFields(result, self.fields)))
+
+    def evaluate(self, fields):
+        """
+        Calculates score for fields from scoreFields. Fields can be numpy arrays,
+        and the result is broadcast from all of them.
+        """
+        with np.errstate(all='ignore'):
+            return self._fn(fields)
+
+    def _compile(self, node):
+        """Converts expression tree to a function of fields"""
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = node.value
+            return lambda fields: value
+        if isinstance(node, ast.Name):
+            name = node.id
+            known = ResultFields + EngagementFields + BreachFields + DamageFields + [field + '_ap' for field in DamageFields]
+            if name not in known:
+                raise ValueError("Unknown field '%s' in score expression '%s'" % (name, self.expression))
+            self.fields.add(name)
+            return lambda fields: fields[name]
+        if isinstance(node, ast.BinOp) and type(node.op) in BinaryOps:
+            op = BinaryOps[type(node.op)]
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda fields: op(left(fields), right(fields))
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda fields: -operand(fields)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Not):
+                return lambda fields: np.logical_not(operand(fields))
+        if isinstance(node, ast.BoolOp):
+            values = [self._compile(value) for value in node.values]
+            op = _reduce(np.logical_and if isinstance(node.op, ast.And) else np.logical_or)
+            return lambda fields: op(*[value(fields) for value in values])
+        if isinstance(node, ast.Compare) and all(type(op) in CompareOps for op in node.ops):
+            operands = [self._compile(value) for value in [node.left] + node.comparators]
+            ops = [CompareOps[type(op)] for op in node.ops]
+
+            def compare(fields):
+                values = [operand(fields) for operand in operands]
+                result = True
+                for i, op in enumerate(ops):
+                    result = np.logical_and(result, op(values[i], values[i+1]))
+                return result
+            return compare
+        if isinstance(node, ast.IfExp):
+            test, body, orelse = self._compile(node.test), self._compile(node.body), self._compile(node.orelse)
+            return lambda fields: np.where(test(fields), body(fields), orelse(fields))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in Functions \
+                and not node.keywords and len(node.args) > 0:
+            fn = Functions[node.func.id]
+            args = [self._compile(arg) for arg in node.args]
+            return lambda fields: fn(*[arg(fields) for arg in args])
+        raise ValueError("Unsupported syntax '%s' in score expression '%s'" % (ast.dump(node), self.expression))
+
+
+def makeScoreFn(score):
+    """
+    Converts score definition to a score function
+    @param score: None for DPS, expression string, ScoreExpression or any python callable
+    """
+    if score is None:
+        return ScoreExpression('dps')
+    if isinstance(score, str):
+        return ScoreExpression(score)
+    return score
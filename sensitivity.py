@@ -0,0 +1,125 @@
+"""
+This file contains numerical sensitivity analysis for weapon configs.
+
+It answers the same questions as the 'APS Calculus' notebook (dDPS/dD, dDPS/dQ, dDPS/dNp),
+but for concrete configs, like top results from ShellOptimizer, and without symbolic math.
+All configs and all parameter steps are evaluated by a single calcCannonDataBatch call.
+
+Derivatives are calculated by finite differences, not analytically. The metric can be any value
+from calcCannonDataBatch, and some of them are piecewise: blocks and coolers are rounded up,
+and derived fields like engagement or breach time are added on top of DPS. Analytic derivatives
+would have to repeat every formula of the batch path and follow it on each change, while differences
+use the same code as the optimizer. To show, how reliable a difference is, each gradient is also
+calculated with a 10 times smaller step, and their relative mismatch is reported as 'error'.
+"""
+import numpy as np
+import ftd_calc as FTD
+
+
+# Parameters for sensitivity analysis. Each of them changes listed config values together:
+# adding a propellant module makes the shell longer as well
+SensitivityParams = {
+    'diameter': ['diameter'],
+    'velCharge': ['velCharge'],
+    'propellant': ['propellant', 'modules'],
+    'loaders': ['loaders'],
+    'clipsPerLoader': ['clipsPerLoader'],
+}
+
+# Parameters with infinite slope at zero: rail velocity grows as sqrt(velCharge)
+SingularAtZero = ['velCharge']
+
+# Ratio between the main step and the control step, used to estimate the error
+ControlStepRatio = 10
+
+
+def calcSensitivity(configs, params=None, metric='dps', step=1e-4):
+    """
+    Calculates gradients and elasticities of a metric for several weapon configs.
+    Derivatives are calculated by central differences. Counts (propellant, loaders, clips)
+    are treated as continuous values, like in the symbolic derivation.
+    When a step would make a value negative, forward difference is used.
+    Gradient for velCharge=0 is reported as +-inf, or 0 if charge does not change the metric at all,
+    because rail velocity grows as sqrt(velCharge) and a finite difference would only reflect the step.
+    Elasticity is 0 then, as it is the limit of the relative change at zero charge.
+    @param configs: list of weapon configs with geometry, like results from calcBestShells
+    @param params: list of parameter names from SensitivityParams. All of them by default
+    @param metric: value from calcCannonDataBatch to be differentiated
+    @param step: relative step for differences
+    @returns list of dicts, one per config:
+     - metric - value of the metric
+     - gradient - dict with d(metric)/d(param)
+     - elasticity - dict with d(metric)/d(param) * param / metric. It is a relative change
+       of the metric per relative change of a parameter
+     - error - dict with relative difference between gradients for step and step / ControlStepRatio.
+       Large values mean, that the metric is not smooth near the config, like when a cooler is added
+    """
+    if params is None:
+        params = list(SensitivityParams.keys())
+    columns = FTD.stackConfigs(configs)
+    count = len(configs)
+    steps = [step, step / ControlStepRatio]
+
+    # Row 0 is the base point, then there are two rows for each parameter and step
+    rows = 1 + 2*len(params)*len(steps)
+    batch = {key: np.repeat(value[np.newaxis], rows, axis=0) for key, value in columns.items()}
+    deltas = []
+    for i, (s, param) in enumerate((s, param) for s in steps for param in params):
+        x = columns[param]
+        h = s * np.maximum(np.abs(x), 1.0 if param != 'diameter' else FTD.MIN_DIAMETER)
+        # Use forward difference if backward step goes below zero
+        back = np.where(x - h >= 0, h, 0)
+        for key in SensitivityParams[param]:
+            batch[key][1 + 2*i] += h
+            batch[key][2 + 2*i] -= back
+        deltas.append(h + back)
+
+    data = FTD.calcCannonDataBatch(batch)
+    values = np.broadcast_to(data[metric], (rows, count))
+
+    def derivative(i, k, param):
+        d = (values[1 + 2*i, k] - values[2 + 2*i, k]) / deltas[i][k]
+        if param in SingularAtZero and columns[param][k] == 0 and d != 0:
+            d = np.copysign(np.inf, d)
+        return d
+
+    results = []
+    for k in range(count):
+        base = float(values[0, k])
+        gradient = {}
+        elasticity = {}
+        error = {}
+        for i, param in enumerate(params):
+            main = derivative(i, k, param)
+            control = derivative(i + len(params), k, param)
+            x = columns[param][k]
+            gradient[param] = float(main)
+            elasticity[param] = float(main * x / base) if base != 0 and x != 0 else 0.0
+            if main == control:
+                error[param] = 0.0
+            else:
+                error[param] = float(abs(main - control) / max(abs(main), abs(control)))
+        results.append({metric: base, "gradient": gradient, "elasticity": elasticity, "error": error})
+    return results
+
+
+# Run step check: gradients should not depend on the step size
+def run_step_check(configs, metric='dps', steps=(1e-3, 1e-4, 1e-5), accuracy=1.0):
+    unstable = 0
+    results = [calcSensitivity(configs, metric=metric, step=step) for step in steps]
+    for k, config in enumerate(configs):
+        report = []
+        for param in results[0][k]['gradient']:
+            values = [result[k]['gradient'][param] for result in results]
+            if all(value == values[0] for value in values):
+                continue
+            spread = (max(values) - min(values)) / max(abs(value) for value in values)
+            if not spread * 100 < accuracy:
+                report.append(" - %s: %s" % (param, ", ".join("%g" % value for value in values)))
+        if len(report) > 0:
+            print("Gradients depend on step for shell=%s, diameter=%d" % (str(config['shell']), config['diameter']*1000))
+            unstable += 1
+            for line in report:
+                print(line)
+    if unstable == 0:
+        print('Gradients are stable for steps %s' % ", ".join("%g" % step for step in steps))
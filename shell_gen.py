@@ -4,6 +4,14 @@ This file contains generators for APS shell body parts
 from copy import copy
 
 
+# Head parts, used by headVariants
+HeadParts = ["composite", "apcap", "hollow", "scharge", "sabot", "squash", "fraghead", "flakhead", "skimmer", "hollow",
+             "HEhead"]
+
+# Body parts, used by allBodyGen
+BodyParts = ['bsabot', 'solid', 'HE', 'frag']
+
+
 # Generator for tail sections
 def tailGen(limit, data=None):
     if data is None or len(data) == 0:
@@ -47,7 +55,7 @@ def bodySingleGen(variants):
 def headVariants(limit, data, next_gen, *args):
     # Generator for head variants
     yield from next_gen(limit, data, *args)
-    for head in ["composite", "apcap", "hollow", "scharge", "sabot", "squash", "fraghead", "flakhead", "skimmer", "hollow", "HEhead"]:
+    for head in HeadParts:
         result = data + [head]
         if limit > 1:
             yield from next_gen(limit - 1, copy(result), *args)
@@ -72,7 +80,32 @@ def allBodyGen(limit):
     Note: it can generate a blueprint with a lesser number of elements. It just iterates over all possible variants.
     """
     data = []
-    gens = [bodyGen(part) for part in ['bsabot', 'solid', 'HE', 'frag']]
+    gens = [bodyGen(part) for part in BodyParts]
     for var in headVariants(limit, data, *gens, tailGen):
         if len(var) > 0:
             yield var
+
+
+def countAllBodies(limit):
+    """
+    Number of blueprints, generated by allBodyGen, without enumerating them.
+    It follows the same chain of generators: head, body parts and tail
+    """
+    counts = {}
+
+    def tail(limit, empty):
+        # The same loops as in tailGen: gunpowder, rails and an optional bleeder
+        if empty:
+            return 0
+        return sum(min(limit - i - j + 1, 2) for i in range(limit + 1) for j in range(limit + 1 - i) if i + j > 0)
+
+    def body(stage, limit, empty):
+        if stage == len(BodyParts):
+            return tail(limit, empty)
+        key = (stage, limit, empty)
+        if key not in counts:
+            counts[key] = sum(body(stage + 1, limit - i, empty and i == 0) for i in range(limit + 1))
+        return counts[key]
+
+    heads = body(0, limit - 1, False) if limit > 1 else 1
+    return body(0, limit, True) + len(HeadParts) * heads
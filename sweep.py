@@ -0,0 +1,397 @@
+"""
+This file contains memory-bounded sweeps over blueprints and weapon settings.
+
+A sweep evaluates every blueprint with every combination of diameters, rail charges
+and loader layouts. The full table of candidates can be much bigger than RAM, so candidates
+are evaluated in chunks, which fit into memory_limit, and each chunk is passed to a reducer:
+ - TopK keeps K best candidates by a score expression
+ - Pareto keeps a Pareto front for several objectives
+ - Spill writes feasible candidates of each chunk to a directory, using compact column types
+
+    sweep = Sweep(max_modules=12, memory_limit=512 * 2**20, min_velocity=300)
+    results = sweep.run(Pareto(['dps', '-blocks']), diameter=[0.1, 0.2, 0.3],
+                        velCharge=[0, 1000, 2000], loaders=[1, 2], loader_length=[1, 2, 3])
+
+All calculations are done in float64, so TopK and Pareto results are the same for any chunk size.
+Reduced precision is used only for spilled columns.
+"""
+import json
+import os
+import tracemalloc
+import numpy as np
+import ftd_calc as FTD
+from parts import Parts
+from score import ScoreExpression, makeScoreFn, scoreFields
+
+
+# Columns of candidates, which are stored by reducers, and their storage types.
+# In chunks, where values do not fit, float32 columns are stored as float64,
+# and integer columns are stored with a wider integer type
+SweepColumns = {
+    'blueprint': 'i8',
+    'setting': 'i8',
+    'diameter': 'f8',
+    'velCharge': 'f4',
+    'loaders': 'i1',
+    'clipsPerLoader': 'i1',
+    'belt': 'i1',
+    'loader_length': 'i1',
+    'dps': 'f4',
+    'velocity': 'f4',
+    'period': 'f4',
+    'accuracy': 'f4',
+    'blocks': 'i2',
+    'coolers': 'i2',
+}
+
+# Max value to be stored as float32. Its rounding error is below 0.001,
+# so stored values are the same as float64 ones at precision of report tables
+Float32Limit = 2.0**13
+
+# Approximate memory for a single candidate. Reducers get all fields of a chunk,
+# so it is more than FTD.BytesPerElement for the optimizer, which keeps only the best settings
+SweepBytesPerElement = 512
+
+SpillFormat = 'ftd-sweep'
+SpillVersion = 1
+
+
+class SweepChunk:
+    """
+    Candidates of a single chunk: blueprints on axis 0, settings on axis 1
+    """
+    def __init__(self, blueprints, codes, setting_start, fields, feasible):
+        """
+        @param blueprints: global indices of blueprints in the chunk
+        @param codes: integer coded blueprints
+        @param setting_start: global index of the first setting in the chunk
+        @param fields: config, settings and data from calcCannonDataBatch
+        @param feasible: boolean mask for candidates
+        """
+        self.blueprints = blueprints
+        self.codes = codes
+        self.setting_start = setting_start
+        self.fields = fields
+        self.feasible = feasible
+        self.shape = feasible.shape
+
+    def evaluate(self, expression):
+        """
+        Evaluates score expression for all candidates
+        @returns flat array, infeasible candidates get -inf
+        """
+        value = expression.evaluate(scoreFields(self.fields, expression.fields))
+        return np.where(self.feasible, value, -np.inf).ravel()
+
+    def take(self, flat):
+        """
+        Collects columns for candidates
+        @param flat: flat indices of candidates in the chunk
+        @returns dict with SweepColumns and 'shell' codes
+        """
+        row, col = np.unravel_index(flat, self.shape)
+        columns = {
+            'blueprint': self.blueprints[row],
+            'setting': self.setting_start + col,
+            'shell': self.codes[row],
+        }
+        for key in SweepColumns:
+            if key not in columns:
+                value = np.broadcast_to(self.fields[key], self.shape)
+                columns[key] = value[row, col]
+        return columns
+
+
+def _concat(a, b):
+    if a is None:
+        return b
+    return {key: np.concatenate([a[key], b[key]]) for key in a}
+
+
+def _select(columns, rows):
+    return {key: value[rows] for key, value in columns.items()}
+
+
+class TopK:
+    """
+    Keeps K best candidates by a score expression. Candidates with score <= 0 are dropped.
+    Equal scores are ordered by candidate index, so results do not depend on chunk size
+    """
+    def __init__(self, k=10, score='dps'):
+        self.k = k
+        self.score = makeScoreFn(score)
+        if not isinstance(self.score, ScoreExpression):
+            raise ValueError("TopK score should be a score expression: %s" % str(score))
+        self.rows = None
+
+    def add(self, chunk):
+        score = chunk.evaluate(self.score)
+        flat = np.flatnonzero(score > 0)
+        if len(flat) > self.k:
+            # Everything, which is not below the k-th score, ties are resolved later
+            threshold = np.partition(score[flat], len(flat) - self.k)[len(flat) - self.k]
+            flat = flat[score[flat] >= threshold]
+        columns = chunk.take(flat)
+        columns['score'] = score[flat]
+        self.rows = self._best(_concat(self.rows, columns))
+
+    def _best(self, rows):
+        order = np.lexsort((rows['setting'], rows['blueprint'], -rows['score']))
+        return _select(rows, order[:self.k])
+
+    def finish(self, sweep):
+        """
+        @returns list of weapon configs, the best one is the last, like in calcBestShells
+        """
+        if self.rows is None:
+            return []
+        return [sweep.makeConfig(self.rows, i) for i in reversed(range(len(self.rows['score'])))]
+
+
+def paretoFront(values, blueprints, settings, block=512):
+    """
+    Finds non-dominated points, maximizing all objectives.
+    Exact duplicates are reduced to the point with the lowest candidate index
+    @param values: array (points, objectives)
+    @returns indices of points in the front
+    """
+    keys = [settings, blueprints] + [-values[:, i] for i in reversed(range(values.shape[1]))]
+    # A point can be dominated only by points, which go before it in this order
+    order = np.lexsort(keys)
+    front = np.zeros(0, dtype=int)
+    for start in range(0, len(order), block):
+        candidates = order[start:start + block]
+        # Most points are dominated by the front found so far
+        for first in range(0, len(front), block):
+            ge = np.all(values[front[first:first + block]][np.newaxis] >= values[candidates][:, np.newaxis], axis=2)
+            candidates = candidates[~np.any(ge, axis=1)]
+        # The rest are checked against each other
+        v = values[candidates]
+        inner = np.tril(np.all(v[np.newaxis] >= v[:, np.newaxis], axis=2), -1)
+        front = np.concatenate([front, candidates[~np.any(inner, axis=1)]])
+    return front
+
+
+class Pareto:
+    """
+    Keeps Pareto front of feasible candidates. All objectives are maximized,
+    so use '-blocks' to minimize blocks
+    """
+    def __init__(self, objectives=('dps', '-blocks')):
+        self.objectives = [makeScoreFn(objective) for objective in objectives]
+        for objective in self.objectives:
+            if not isinstance(objective, ScoreExpression):
+                raise ValueError("Pareto objectives should be score expressions: %s" % str(objective))
+        self.rows = None
+
+    def add(self, chunk):
+        values = np.stack([chunk.evaluate(objective) for objective in self.objectives], axis=1)
+        flat = np.flatnonzero(np.all(np.isfinite(values), axis=1))
+        columns = chunk.take(flat)
+        columns['objectives'] = values[flat]
+        front = paretoFront(columns['objectives'], columns['blueprint'], columns['setting'])
+        rows = _concat(self.rows, _select(columns, front))
+        self.rows = _select(rows, paretoFront(rows['objectives'], rows['blueprint'], rows['setting']))
+
+    def finish(self, sweep):
+        """
+        @returns list of weapon configs in the front, ordered by the first objective
+        """
+        if self.rows is None:
+            return []
+        order = np.lexsort((self.rows['setting'], self.rows['blueprint'], self.rows['objectives'][:, 0]))
+        return [sweep.makeConfig(self.rows, i) for i in order]
+
+
+def _storageType(value, dtype):
+    """Storage type from SweepColumns, widened if values do not fit into it"""
+    if dtype == 'f4' and np.any(np.abs(value) >= Float32Limit):
+        return 'f8'
+    while dtype.startswith('i') and dtype != 'i8':
+        limits = np.iinfo(dtype)
+        if np.min(value) >= limits.min and np.max(value) <= limits.max:
+            break
+        dtype = 'i%d' % (2 * int(dtype[1:]))
+    return dtype
+
+
+class Spill:
+    """
+    Writes feasible candidates of each chunk to a directory.
+    Columns are stored with compact types from SweepColumns. Use readSpill to load them
+    """
+    def __init__(self, path):
+        self.path = path
+        self.chunks = 0
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, chunk):
+        flat = np.flatnonzero(chunk.feasible)
+        if len(flat) == 0:
+            return
+        columns = chunk.take(flat)
+        stored = {'shell': np.asarray(columns['shell'], dtype=np.int8)}
+        for key, dtype in SweepColumns.items():
+            stored[key] = columns[key].astype(_storageType(columns[key], dtype))
+        np.savez(os.path.join(self.path, 'chunk-%06d.npz' % self.chunks), **stored)
+        self.chunks += 1
+        self.count += len(flat)
+
+    def finish(self, sweep):
+        """
+        Writes sweep description
+        @returns path to spill directory
+        """
+        info = {
+            "format": SpillFormat,
+            "version": SpillVersion,
+            "parts": Parts.fingerprint,
+            "chunks": self.chunks,
+            "count": self.count,
+            "settings": sweep.settingsCount,
+        }
+        with open(os.path.join(self.path, 'sweep.json'), 'w') as file:
+            json.dump(info, file, indent=2)
+        return self.path
+
+
+def readSpill(path):
+    """
+    Reads candidates, spilled by Spill reducer, chunk by chunk
+    @returns generator for dicts with column arrays
+    """
+    with open(os.path.join(path, 'sweep.json')) as file:
+        info = json.load(file)
+    if info.get('format') != SpillFormat or info.get('version') != SpillVersion:
+        raise ValueError("%s is not a sweep directory of version %d" % (path, SpillVersion))
+    for i in range(info['chunks']):
+        with np.load(os.path.join(path, 'chunk-%06d.npz' % i)) as data:
+            yield {key: data[key] for key in data.files}
+
+
+class Sweep:
+    """
+    Evaluates all blueprints with all combinations of weapon settings in memory-bounded chunks
+    """
+    def __init__(self, max_modules=4, atlas=None, memory_limit=FTD.DefaultMemoryLimit, **kwargs):
+        """
+        @param max_modules: max shell modules to be used
+        @param atlas: BlueprintAtlas with precalculated blueprints. Blueprints are enumerated if it is not set
+        @param memory_limit: approximate memory limit for evaluation, in bytes
+        Hard limits from ShellConstraints can be passed here as well. Skip counts are stored in 'skipped'
+        """
+        self.max_modules = max_modules
+        self.atlas = atlas
+        self.memory_limit = memory_limit
+        self.constraints = FTD.ShellConstraints(**kwargs)
+        self.settings = None
+        self.settingsCount = 0
+        self.config = {}
+
+    @property
+    def skipped(self):
+        """
+        Number of blueprints, skipped by each constraint during the last run.
+        A blueprint is counted only when all its settings are rejected, and it goes to the constraint,
+        which rejects the last of them. Candidates, rejected while other settings of the blueprint
+        are feasible, are not counted. When settings do not fit into a single chunk, a blueprint
+        is counted for each part of settings
+        """
+        return self.constraints.skipped
+
+    def _makeSettings(self, diameter, velCharge, loaders, clipsPerLoader, belt, loader_length):
+        """All combinations of weapon settings, as flat arrays"""
+        table = FTD.makeLoaderTable(loaders, clipsPerLoader, belt, loader_length)
+        diameters = np.clip(np.atleast_1d(np.asarray(diameter, dtype=float)), FTD.MIN_DIAMETER, FTD.MAX_DIAMETER)
+        charges = np.atleast_1d(np.asarray(velCharge, dtype=float))
+        layouts = np.arange(len(table['loaders']))
+        grids = np.meshgrid(np.arange(len(diameters)), np.arange(len(charges)), layouts, indexing='ij')
+        d, c, layout = [grid.ravel() for grid in grids]
+        settings = {key: value[layout] for key, value in table.items()}
+        settings['diameter'] = diameters[d]
+        settings['velCharge'] = charges[c]
+        return settings
+
+    def run(self, reducer, diameter, velCharge=0, loaders=1, clipsPerLoader=1, belt=False, loader_length=1,
+            **kwargs):
+        """
+        Runs the sweep
+        @param reducer: TopK, Pareto or Spill
+        @param diameter: shell diameter or a list of diameters
+        @param velCharge, loaders, clipsPerLoader, belt, loader_length: a number or a list of values
+        All other arguments are copied to weapon config
+        @returns result of the reducer
+        """
+        constraints = self.constraints
+        constraints.reset()
+        self.config = kwargs
+        self.settings = self._makeSettings(diameter, velCharge, loaders, clipsPerLoader, belt, loader_length)
+        total = len(self.settings['diameter'])
+        self.settingsCount = total
+
+        elements = max(1, self.memory_limit // (SweepBytesPerElement * FTD.calcCandidateWidth(kwargs)))
+        setting_chunk = min(total, elements)
+        blueprint_chunk = max(1, elements // setting_chunk)
+        parts = self.atlas.parts if self.atlas is not None else FTD.ShellParts
+
+        for start, codes, columns in FTD.blueprintChunks(self.max_modules, blueprint_chunk, self.atlas):
+            rows = np.flatnonzero(columns['modules'] <= self.max_modules)
+            rows = rows[constraints.maskBlueprints(codes[rows], parts)]
+            if len(rows) == 0:
+                continue
+            config = dict(kwargs)
+            config.update({key: np.asarray(columns[key][rows], dtype=float)[:, np.newaxis]
+                           for key in FTD.BulletColumns})
+            for first in range(0, total, setting_chunk):
+                grid = {key: value[np.newaxis, first:first + setting_chunk] for key, value in self.settings.items()}
+                fields, feasible = FTD.calcCandidates(config, grid, constraints, constraints.maskLayouts(config, grid))
+                reducer.add(SweepChunk(start + rows, np.asarray(codes[rows]), first, fields, feasible))
+        return reducer.finish(self)
+
+    def makeConfig(self, rows, i):
+        """
+        Calculates weapon config for a candidate, kept by a reducer
+        @param rows: dict with columns from SweepChunk.take
+        @param i: index of the candidate in rows
+        """
+        parts = self.atlas.parts if self.atlas is not None else FTD.ShellParts
+        config = dict(FTD.calcBulletStats(FTD.decodeBlueprint(rows['shell'][i], parts)), **self.config)
+        setting = rows['setting'][i]
+        for key in FTD.LoaderSearchKeys + ['velCharge']:
+            config[key] = self.settings[key][setting].item()
+        FTD.calcBulletGeometry(config, self.settings['diameter'][setting].item())
+        FTD.calcCannonData(config)
+        return config
+
+
+# Run memory check: peak allocation of batch evaluation should stay below memory_limit
+def run_memory_check(memory_limit=64 * 2**20, max_modules=6):
+    settings = dict(loader_length=[1, 2], loaders=[1, 2], clipsPerLoader=[1, 2, 3])
+    ranges = [250, 500, 1000, 2000]
+    layouts = [['metal'], ['metal', 'HA'], ['alloy'] * 4]
+    checks = {
+        "charge search": lambda: FTD.ShellOptimizer(
+            max_modules=max_modules, objective='dps_per_block', score_fn='dps', memory_limit=memory_limit
+        ).calcBestShells(velCharge='auto', max_charge=40000, **settings),
+        "engagement": lambda: FTD.ShellOptimizer(
+            max_modules=max_modules, score_fn='delivered_dps', memory_limit=memory_limit
+        ).calcBestShells(velCharge=[0, 1000], ranges=ranges, **settings),
+        "breach": lambda: FTD.ShellOptimizer(
+            max_modules=max_modules, score_fn='1 / breach_time', memory_limit=memory_limit, min_diameter=0.1
+        ).calcBestShells(velCharge=[0, 1000], armor_layouts=layouts, **settings),
+        "sweep": lambda: Sweep(max_modules=max_modules, memory_limit=memory_limit).run(
+            TopK(), diameter=[0.1, 0.2, 0.3], velCharge=[0, 1000, 2000], **settings),
+    }
+    exceeded = 0
+    for name, check in checks.items():
+        tracemalloc.start()
+        with np.errstate(invalid='ignore'):
+            check()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if peak > memory_limit:
+            print("Memory check failed for %s: peak=%.1fMB vs limit=%.1fMB" % (name, peak / 2**20, memory_limit / 2**20))
+            exceeded += 1
+    if exceeded == 0:
+        print('Memory limits are fine so far')
@@ -1,5 +1,7 @@
 import ftd_calc as FTD
 import json
+import sensitivity
+import sweep
 
 shell_ref = dict(shell=['HE', 'HE', 'bleeder', 'gunpowder'])
 FTD.calcBulletGeometry(shell_ref, diameter=0.5)
@@ -53,3 +55,5 @@ real_data = [
 
 
 FTD.run_verification(real_data)
+sweep.run_memory_check()
+sensitivity.run_step_check(FTD.ShellOptimizer(max_modules=5, score_fn='dps').calcBestShells(loader_length=2, velCharge=[0, 1000]))